@@ -210,10 +210,12 @@ async def conv_reason_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                              issuer.first_name or "", reason=reason)
 
     elif action == "warn":
-        warns = await db.add_warn(tid, reason, issuer.id)
+        async with db.transaction():
+            warns = await db.add_warn(tid, reason, issuer.id)
+            if warns >= MAX_WARNS:
+                await db.set_ban(tid, 0, f"Автобан: {warns} варнов", issuer.id)
         text = f"⚠️ <b>Варн</b>\n{escape_html(tname)} — {warns}/{MAX_WARNS}{reason_str}"
         if warns >= MAX_WARNS:
-            await db.set_ban(tid, 0, f"Автобан: {warns} варнов", issuer.id)
             for c in await db.get_all_chats():
                 try:
                     await context.bot.ban_chat_member(c["chat_id"], tid)
@@ -256,8 +258,7 @@ async def cb_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     page = int(q.data.split(":")[2]) if len(q.data.split(":")) > 2 else 0
-    total = await db.count_users()
-    users = await db.get_all_users(page * USERS_PER_PAGE, USERS_PER_PAGE)
+    users, total = await db.get_users_page(page, USERS_PER_PAGE)
     await q.edit_message_text("👥 <b>Пользователи</b>",
                               reply_markup=users_list_kb(users, page, total), parse_mode=ParseMode.HTML)
 
@@ -19,11 +19,17 @@ from utils import (
     escape_html, role_name, can_moderate, can_admin,
 )
 from keyboards import back_to_main_kb, users_list_kb, chats_list_kb, settings_kb, cancel_kb
-from ai_moderation import analyze_message
+import ai_moderation
 from staff_log import log_punishment, log_action
+from antiflood import FloodLimiter
 
 logger = logging.getLogger(__name__)
 
+# Флуд: больше SPAM_MESSAGES_COUNT сообщений за SPAM_INTERVAL_SECONDS * SPAM_MESSAGES_COUNT секунд.
+# Нарушения (strike) считаются на пользователя во всех чатах — ключ (user_id, 0).
+flood = FloodLimiter(burst=SPAM_MESSAGES_COUNT, window=SPAM_INTERVAL_SECONDS * SPAM_MESSAGES_COUNT,
+                     idle_ttl=3600)
+
 
 async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -115,11 +121,13 @@ async def cmd_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not target:
         await update.message.reply_text("❌ Не найден."); return
     reason = " ".join(context.args[1:]) if len(context.args) > 1 else ""
-    warns = await db.add_warn(target["user_id"], reason, update.effective_user.id)
+    async with db.transaction():
+        warns = await db.add_warn(target["user_id"], reason, update.effective_user.id)
+        if warns >= MAX_WARNS:
+            await db.set_ban(target["user_id"], 0, f"Автобан: {warns} варнов", update.effective_user.id)
     name = escape_html(target.get("first_name") or str(target["user_id"]))
     text = f"⚠️ Варн: {name} ({warns}/{MAX_WARNS})"
     if warns >= MAX_WARNS:
-        await db.set_ban(target["user_id"], 0, f"Автобан: {warns} варнов", update.effective_user.id)
         for c in await db.get_all_chats():
             try: await context.bot.ban_chat_member(c["chat_id"], target["user_id"])
             except: pass
@@ -247,8 +255,7 @@ async def cmd_globalban(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = await db.get_role(update.effective_user.id)
     if not can_moderate(role): return
-    total = await db.count_users()
-    users = await db.get_all_users(0, USERS_PER_PAGE)
+    users, total = await db.get_users_page(0, USERS_PER_PAGE)
     iface = await db.get_interface(update.effective_user.id)
     if iface == INTERFACE_BUTTONS:
         await update.message.reply_text("👥", reply_markup=users_list_kb(users, 0, total), parse_mode=ParseMode.HTML)
@@ -393,29 +400,19 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         except: pass
         return
 
-    word_filters = await db.get_word_filters(chat_id)
-    for word in word_filters:
-        if word in text:
-            try:
-                await update.message.delete()
-                await context.bot.send_message(chat_id,
-                    f"🚫 Сообщение от {escape_html(user.first_name or str(user.id))} удалено",
-                    parse_mode=ParseMode.HTML)
-            except: pass
-            return
+    word_filter = await db.get_word_filter_matcher(chat_id)
+    if word_filter.find(text):
+        try:
+            await update.message.delete()
+            await context.bot.send_message(chat_id,
+                f"🚫 Сообщение от {escape_html(user.first_name or str(user.id))} удалено",
+                parse_mode=ParseMode.HTML)
+        except: pass
+        return
 
     if chat_info.get("antispam"):
-        key = f"spam_{user.id}_{chat_id}"
-        now = time.time()
-        ts = context.bot_data.get(key, [])
-        ts = [t for t in ts if now - t < SPAM_INTERVAL_SECONDS * SPAM_MESSAGES_COUNT]
-        ts.append(now)
-        context.bot_data[key] = ts
-
-        if len(ts) > SPAM_MESSAGES_COUNT:
-            wk = f"sw_{user.id}"
-            sw = context.bot_data.get(wk, 0) + 1
-            context.bot_data[wk] = sw
+        if flood.hit(user.id, chat_id):
+            sw = flood.strike(user.id)
             try: await update.message.delete()
             except: pass
 
@@ -429,7 +426,7 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
                         f"🔇 {escape_html(user.first_name or str(user.id))} замучен на 1 час (флуд)",
                         parse_mode=ParseMode.HTML)
                 except: pass
-                context.bot_data[wk] = 0
+                flood.reset_strikes(user.id)
                 await log_action(context.bot, f"🔇 Автомут за флуд: {user.first_name} ({user.id})")
             else:
                 await db.add_warn(user.id, "Флуд", 0, chat_id)
@@ -441,44 +438,61 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
             return
 
     if chat_info.get("ai_moderation") and text:
-        result = await analyze_message(text)
-        if result and result.get("violation"):
-            action = result.get("action", "warn")
-            reason = result.get("reason", "Нарушение (ИИ)")
-            try: await update.message.delete()
+        # Анализ идёт в фоне; при переполненной очереди — эвристики на месте
+        job = {"bot": context.bot, "chat_id": chat_id, "message_id": update.message.message_id,
+               "user_id": user.id, "first_name": user.first_name or "", "text": text}
+        if not ai_moderation.queue.submit(chat_id, job):
+            verdict = ai_moderation.heuristic_verdict(text)
+            if verdict:
+                await apply_ai_verdict(job, verdict)
+
+
+async def apply_ai_verdict(job: dict, result: dict):
+    """Применяет вердикт ИИ (или эвристики) к сообщению из job."""
+    if not result.get("violation"):
+        return
+    bot, chat_id, uid = job["bot"], job["chat_id"], job["user_id"]
+    first_name = job["first_name"]
+    action = result.get("action", "warn")
+    reason = result.get("reason", "Нарушение (ИИ)")
+    try: await bot.delete_message(chat_id, job["message_id"])
+    except: pass
+    uname = escape_html(first_name or str(uid))
+
+    if action == "delete":
+        return
+    if action == "ban":
+        until = time.time() + 86400
+        await db.set_ban(uid, until, reason, 0, chat_id)
+        try:
+            await bot.ban_chat_member(chat_id, uid, until_date=int(until))
+            await bot.send_message(chat_id,
+                f"🤖🔨 {uname} забанен: {escape_html(reason)}", parse_mode=ParseMode.HTML)
+        except: pass
+        await log_action(bot, f"🤖🔨 ИИ-бан: {first_name} ({uid}) — {reason}")
+    elif action == "mute":
+        until = time.time() + 3600
+        await db.set_mute(uid, until, reason, 0, chat_id)
+        try:
+            await bot.restrict_chat_member(chat_id, uid,
+                permissions=ChatPermissions(can_send_messages=False), until_date=int(until))
+            await bot.send_message(chat_id,
+                f"🤖🔇 {uname} замучен: {escape_html(reason)}", parse_mode=ParseMode.HTML)
+        except: pass
+        await log_action(bot, f"🤖🔇 ИИ-мут: {first_name} ({uid}) — {reason}")
+    else:
+        async with db.transaction():
+            warns = await db.add_warn(uid, reason, 0, chat_id)
+            if warns >= MAX_WARNS:
+                await db.set_ban(uid, 0, f"Автобан: {warns} варнов", 0)
+        try:
+            await bot.send_message(chat_id,
+                f"🤖⚠️ {uname}: {escape_html(reason)} [{warns}/{MAX_WARNS}]",
+                parse_mode=ParseMode.HTML)
+        except: pass
+        if warns >= MAX_WARNS:
+            try: await bot.ban_chat_member(chat_id, uid)
             except: pass
-            uname = escape_html(user.first_name or str(user.id))
-
-            if action == "ban":
-                until = time.time() + 86400
-                await db.set_ban(user.id, until, reason, 0, chat_id)
-                try:
-                    await context.bot.ban_chat_member(chat_id, user.id, until_date=int(until))
-                    await context.bot.send_message(chat_id,
-                        f"🤖🔨 {uname} забанен: {escape_html(reason)}", parse_mode=ParseMode.HTML)
-                except: pass
-                await log_action(context.bot, f"🤖🔨 ИИ-бан: {user.first_name} ({user.id}) — {reason}")
-            elif action == "mute":
-                until = time.time() + 3600
-                await db.set_mute(user.id, until, reason, 0, chat_id)
-                try:
-                    await context.bot.restrict_chat_member(chat_id, user.id,
-                        permissions=ChatPermissions(can_send_messages=False), until_date=int(until))
-                    await context.bot.send_message(chat_id,
-                        f"🤖🔇 {uname} замучен: {escape_html(reason)}", parse_mode=ParseMode.HTML)
-                except: pass
-                await log_action(context.bot, f"🤖🔇 ИИ-мут: {user.first_name} ({user.id}) — {reason}")
-            else:
-                warns = await db.add_warn(user.id, reason, 0, chat_id)
-                try:
-                    await context.bot.send_message(chat_id,
-                        f"🤖⚠️ {uname}: {escape_html(reason)} [{warns}/{MAX_WARNS}]",
-                        parse_mode=ParseMode.HTML)
-                except: pass
-                if warns >= MAX_WARNS:
-                    await db.set_ban(user.id, 0, f"Автобан: {warns} варнов", 0)
-                    try: await context.bot.ban_chat_member(chat_id, user.id)
-                    except: pass
 
 
 async def private_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
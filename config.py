@@ -43,12 +43,33 @@ REPORT_TOPIC_ID: int = int(_cfg.get("report_topic_id", 0) or 0)
 # Ссылка на поддержку
 SUPPORT_LINK: str = str(_cfg.get("support_link", "")).strip()
 
+# Сколько топиков стафф-чата отправщик логов обслуживает параллельно
+STAFF_OUTBOX_CONCURRENCY: int = int(_cfg.get("staff_outbox_concurrency", 4) or 4)
+
 # ==============================
 # PERPLEXITY AI
 # ==============================
 
 PERPLEXITY_API_KEY: str = str(_cfg.get("perplexity_api_key", "")).strip()
 PERPLEXITY_MODEL: str = str(_cfg.get("perplexity_model", "llama-3.1-sonar-large-128k-online")).strip()
+PERPLEXITY_API_URL: str = str(_cfg.get("perplexity_api_url", "https://api.perplexity.ai/chat/completions")).strip()
+
+# Общий HTTP-клиент ИИ-модерации: keep-alive соединений в пуле и таймаут запроса
+AI_HTTP_CONNECTIONS: int = int(_cfg.get("ai_http_connections", 8) or 8)
+AI_HTTP_TIMEOUT: float = float(_cfg.get("ai_http_timeout", 15) or 15)
+
+# Кэш вердиктов по нормализованному тексту: сколько секунд и сколько записей
+AI_VERDICT_TTL: int = int(_cfg.get("ai_verdict_ttl", 3600) or 3600)
+AI_VERDICT_CACHE_SIZE: int = int(_cfg.get("ai_verdict_cache_size", 10000) or 10000)
+
+# Микро-батчи: до AI_BATCH_SIZE сообщений в одном запросе, сбор не дольше AI_BATCH_WAIT_MS
+AI_BATCH_SIZE: int = int(_cfg.get("ai_batch_size", 10) or 10)
+AI_BATCH_WAIT_MS: int = int(_cfg.get("ai_batch_wait_ms", 200) or 200)
+
+# Очередь ИИ-проверок: столько воркеров анализируют параллельно (≥ AI_BATCH_SIZE,
+# чтобы батчи наполнялись), при AI_QUEUE_SIZE ждущих — локальные эвристики
+AI_WORKERS: int = int(_cfg.get("ai_workers", 20) or 20)
+AI_QUEUE_SIZE: int = int(_cfg.get("ai_queue_size", 500) or 500)
 
 # ==============================
 # БАЗА ДАННЫХ
@@ -57,6 +78,14 @@ PERPLEXITY_MODEL: str = str(_cfg.get("perplexity_model", "llama-3.1-sonar-large-
 # По умолчанию храним БД в ./data/bot.db (папка будет создана автоматически).
 DATABASE_PATH: str = os.path.join(BASE_DIR, "data", "bot.db")
 
+# Сколько читающих соединений держит пул (писатель всегда один).
+DATABASE_READERS: int = int(_cfg.get("database_readers", 4) or 4)
+
+# Счётчики сообщений копятся в памяти и сбрасываются в БД одной транзакцией
+# раз в WRITE_BEHIND_INTERVAL_MS или при накоплении WRITE_BEHIND_MAX_ROWS строк.
+WRITE_BEHIND_INTERVAL_MS: int = int(_cfg.get("write_behind_interval_ms", 1000) or 1000)
+WRITE_BEHIND_MAX_ROWS: int = int(_cfg.get("write_behind_max_rows", 500) or 500)
+
 # ==============================
 # ПРЕДУСТАНОВЛЕННЫЕ РОЛИ (user_id -> level)
 # ==============================
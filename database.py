@@ -1,20 +1,139 @@
 """
 БД — SQLite через aiosqlite.
+
+Соединения долгоживущие: один писатель и несколько читателей в режиме WAL
+(см. _ConnectionPool). Пул открывается в init_db() и закрывается в close_db().
 """
 
+import asyncio
+import logging
 import os
 import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
 import aiosqlite
-from config import DATABASE_PATH, ROLE_USER, PRESET_STAFF, MODERATED_CHATS
+from config import (
+    DATABASE_PATH, DATABASE_READERS, ROLE_USER, PRESET_STAFF, MODERATED_CHATS,
+    WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_MAX_ROWS,
+)
+
+from wordfilter import WordMatcher
+from pagination import KeysetPager
+from queryplan import check_query_plans
+from expiry import ExpiryScheduler
+import migrations
+
+logger = logging.getLogger(__name__)
 
 DB_DIR = os.path.dirname(DATABASE_PATH)
 
+# Применяются к каждому соединению пула при открытии.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+
+class _ConnectionPool:
+    """Один писатель + N читателей поверх одного файла SQLite.
+
+    В WAL читатели не блокируют писателя и друг друга, поэтому чтения
+    раздаются из очереди соединений, а все записи идут через одно соединение
+    под asyncio.Lock и коммитятся при выходе из write(). Вложенный write()
+    в той же задаче не коммитит — это делает внешний (см. transaction()).
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._writer: aiosqlite.Connection | None = None
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._all_readers: list[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._write_owner: asyncio.Task | None = None
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in _PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # Писатель открывается первым: он переводит файл в WAL.
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            conn = await self._connect(read_only=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers.clear()
+            self._readers = None
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        if self._readers is None:
+            raise RuntimeError("База данных не инициализирована: вызови init_db()")
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        if self._writer is None:
+            raise RuntimeError("База данных не инициализирована: вызови init_db()")
+        task = asyncio.current_task()
+        if self._write_owner is task:
+            yield self._writer
+            return
+        async with self._write_lock:
+            self._write_owner = task
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+            finally:
+                self._write_owner = None
+
+
+_pool = _ConnectionPool(DATABASE_PATH, DATABASE_READERS)
+
+
+def transaction():
+    """Несколько записей одной транзакцией: коммит на выходе, откат при ошибке.
+
+    Внутри блока не ждать сеть — остальные записи стоят на блокировке.
+    """
+    return _pool.write()
+
 
 async def init_db():
     if DB_DIR and not os.path.exists(DB_DIR):
         os.makedirs(DB_DIR, exist_ok=True)
 
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    await _pool.open()
+    async with _pool.write() as db:
         await db.executescript("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -68,8 +187,25 @@ async def init_db():
                 banned_by INTEGER DEFAULT 0,
                 banned_at REAL DEFAULT 0
             );
+            CREATE TABLE IF NOT EXISTS staff_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic_id INTEGER DEFAULT 0,
+                text TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_at REAL DEFAULT 0,
+                created_at REAL DEFAULT 0
+            );
         """)
-        await db.commit()
+
+    pending = await migrations.run_startup(_pool.write, _MIGRATIONS)
+
+    async with _pool.read() as db:
+        async with db.execute("SELECT user_id FROM global_bans") as cur:
+            _global_bans.update(r[0] for r in await cur.fetchall())
+        for kind, flag, column in _EXPIRING:
+            async with db.execute(f"SELECT user_id, {column} FROM users WHERE {flag}=1 AND {column}>0") as cur:
+                _expiry.load(((kind, r[0]), r[1]) for r in await cur.fetchall())
+    _expiry.start()
 
     # Применяем предустановленные роли
     for uid, level in PRESET_STAFF.items():
@@ -80,20 +216,150 @@ async def init_db():
     for cid in MODERATED_CHATS:
         await ensure_chat(cid)
 
+    for u in await get_staff_users():
+        _remember_role(u["user_id"], u["role"])
+
+    global _flush_task, _migrate_task
+    _flush_task = asyncio.create_task(_flush_loop())
+    _migrate_task = asyncio.create_task(_migrate_online(pending))
+
+
+# Изменения схемы — только сюда, с новым номером версии.
+# online=True: индексы и backfill, идут в фоне после старта.
+_MIGRATIONS = [
+    {"version": 1, "name": "idx_users", "online": True,
+     "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_users_messages ON users(messages_count)",
+                                 "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)",
+                                 "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")},
+    {"version": 2, "name": "idx_punishments_user", "online": True,
+     "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_punishments_user ON punishments(user_id, issued_at)")},
+    {"version": 3, "name": "idx_word_filters_chat", "online": True,
+     "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_word_filters_chat ON word_filters(chat_id)")},
+    {"version": 4, "name": "idx_reports_status", "online": True,
+     "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status, created_at)")},
+    {"version": 5, "name": "idx_users_until", "online": True,
+     "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_users_ban_until ON users(ban_until) WHERE is_banned=1",
+                                 "CREATE INDEX IF NOT EXISTS idx_users_mute_until ON users(mute_until) WHERE is_muted=1")},
+]
+_migrate_task: asyncio.Task | None = None
+
+
+async def _migrate_online(pending: list):
+    """Фоновые миграции через писателя пула: читатели работают, записи ждут одну миграцию."""
+    await migrations.run_online(_pool.write, pending)
+    # Планы — на писателе: он строил индексы, схема у него свежая
+    async with _pool.write() as db:
+        await check_query_plans(db, _HOT_QUERIES)
+
+
+# Запросы, которые не должны деградировать до полного прохода по таблице
+_HOT_QUERIES = {
+    "get_user": ("SELECT * FROM users WHERE user_id = ?", (0,)),
+    "users_page": ("SELECT user_id AS _key, * FROM users WHERE 1 AND (messages_count, user_id) < (?, ?) "
+                   "ORDER BY messages_count DESC, user_id DESC LIMIT ?", (0, 0, 10)),
+    "top_users": ("SELECT * FROM users ORDER BY messages_count DESC LIMIT ?", (10,)),
+    "staff_users": ("SELECT * FROM users WHERE role > 0 ORDER BY role DESC", ()),
+    "online_users": ("SELECT * FROM users WHERE last_seen > ?", (0,)),
+    "user_punishments": ("SELECT * FROM punishments WHERE user_id=? ORDER BY issued_at DESC LIMIT ?", (0, 20)),
+    "chat": ("SELECT * FROM chats WHERE chat_id=?", (0,)),
+    "word_filters": ("SELECT word FROM word_filters WHERE chat_id=?", (0,)),
+    "open_reports": ("SELECT * FROM reports WHERE status='open' ORDER BY created_at DESC LIMIT ?", (20,)),
+}
+
+
+async def close_db():
+    global _flush_task, _migrate_task
+    await _expiry.close()
+    if _migrate_task is not None:
+        _migrate_task.cancel()
+        try:
+            await _migrate_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _migrate_task = None
+    if _flush_task is not None:
+        # Дожидаемся отмены: прерванный flush вернёт пачку в буфер до финального
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    try:
+        await flush_messages()
+    except Exception as e:
+        logger.warning(f"flush on shutdown: {e}")
+    await _pool.close()
+
+
+# ===================== WRITE-BEHIND =====================
+
+# user_id -> [прирост messages_count, последний last_seen]
+_pending_messages: dict[int, list] = {}
+_flush_task: asyncio.Task | None = None
+
+
+async def flush_messages():
+    """Сбрасывает накопленные счётчики сообщений одной транзакцией."""
+    global _pending_messages
+    if not _pending_messages:
+        return
+    batch, _pending_messages = _pending_messages, {}
+    try:
+        async with _pool.write() as db:
+            await db.executemany(
+                "UPDATE users SET messages_count=messages_count+?, last_seen=MAX(last_seen, ?) WHERE user_id=?",
+                [(delta, seen, uid) for uid, (delta, seen) in batch.items()])
+    except BaseException:
+        # Возвращаем несохранённое обратно (в том числе при отмене на остановке)
+        for uid, (delta, seen) in batch.items():
+            entry = _pending_messages.setdefault(uid, [0, seen])
+            entry[0] += delta
+            entry[1] = max(entry[1], seen)
+        raise
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(WRITE_BEHIND_INTERVAL_MS / 1000)
+        try:
+            await flush_messages()
+        except Exception as e:
+            logger.warning(f"flush_messages: {e}")
+
 
 # ===================== USERS =====================
 
 async def get_user(user_id: int) -> dict | None:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cur:
             row = await cur.fetchone()
             return dict(row) if row else None
 
 
+# user_id -> (username, first_name), уже лежащие в users. Известный пользователь
+# с теми же именами в БД синхронно не пишется: last_seen уходит в буфер сообщений.
+_known_users: dict[int, tuple[str, str]] = {}
+KNOWN_USERS_MAX = 200_000
+
+
+def _touch(user_id: int, now: float):
+    entry = _pending_messages.get(user_id)
+    if entry:
+        entry[1] = max(entry[1], now)
+    else:
+        _pending_messages[user_id] = [0, now]
+
+
 async def ensure_user(user_id: int, username: str = "", first_name: str = ""):
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    known = _known_users.get(user_id)
+    if known is not None and (not (username or first_name) or known == (username, first_name)):
+        _touch(user_id, now)
+        if len(_pending_messages) >= WRITE_BEHIND_MAX_ROWS:
+            await flush_messages()
+        return
+    async with _pool.write() as db:
         async with db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,)) as cur:
             exists = await cur.fetchone()
         if exists:
@@ -107,13 +373,15 @@ async def ensure_user(user_id: int, username: str = "", first_name: str = ""):
             await db.execute(
                 "INSERT INTO users (user_id, username, first_name, joined_at, last_seen) VALUES (?,?,?,?,?)",
                 (user_id, username, first_name, now, now))
-        await db.commit()
+    if username or first_name or not exists:
+        if len(_known_users) >= KNOWN_USERS_MAX:
+            _known_users.clear()
+        _known_users[user_id] = (username, first_name)
 
 
 async def set_interface(user_id: int, interface: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET interface=? WHERE user_id=?", (interface, user_id))
-        await db.commit()
 
 
 async def get_interface(user_id: int) -> str:
@@ -121,46 +389,82 @@ async def get_interface(user_id: int) -> str:
     return u["interface"] if u and u["interface"] else ""
 
 
+# user_id -> итоговая роль (LRU). Прогревается стаффом в init_db, сбрасывается в set_role.
+_roles: "OrderedDict[int, int]" = OrderedDict()
+_roles_gen = 0
+ROLE_CACHE_MAX = 100_000
+role_cache_hits = 0
+role_cache_misses = 0
+
+
+def _remember_role(user_id: int, role: int):
+    _roles[user_id] = role
+    _roles.move_to_end(user_id)
+    while len(_roles) > ROLE_CACHE_MAX:
+        _roles.popitem(last=False)
+
+
+def role_cache_stats() -> dict:
+    return {"size": len(_roles), "hits": role_cache_hits, "misses": role_cache_misses}
+
+
 async def set_role(user_id: int, role: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    global _roles_gen
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET role=? WHERE user_id=?", (role, user_id))
-        await db.commit()
+    _roles_gen += 1
+    _roles.pop(user_id, None)
 
 
 async def get_role(user_id: int) -> int:
+    global role_cache_hits, role_cache_misses
+    role = _roles.get(user_id)
+    if role is not None:
+        role_cache_hits += 1
+        _roles.move_to_end(user_id)
+        return role
+    role_cache_misses += 1
+    gen = _roles_gen
     u = await get_user(user_id)
     if not u:
-        return PRESET_STAFF.get(user_id, ROLE_USER)
-    return u["role"] if u["role"] > 0 else PRESET_STAFF.get(user_id, ROLE_USER)
+        role = PRESET_STAFF.get(user_id, ROLE_USER)
+    else:
+        role = u["role"] if u["role"] > 0 else PRESET_STAFF.get(user_id, ROLE_USER)
+    if gen == _roles_gen:
+        _remember_role(user_id, role)
+    return role
 
 
 async def increment_messages(user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            "UPDATE users SET messages_count=messages_count+1, last_seen=? WHERE user_id=?",
-            (time.time(), user_id))
-        await db.commit()
+    """Учитывает сообщение в буфере; в БД попадёт при ближайшем flush_messages()."""
+    now = time.time()
+    entry = _pending_messages.get(user_id)
+    if entry:
+        entry[0] += 1
+        entry[1] = now
+    else:
+        _pending_messages[user_id] = [1, now]
+    if len(_pending_messages) >= WRITE_BEHIND_MAX_ROWS:
+        await flush_messages()
 
 
-async def get_all_users(offset: int = 0, limit: int = 10):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM users ORDER BY messages_count DESC LIMIT ? OFFSET ?", (limit, offset)
-        ) as cur:
-            return [dict(r) for r in await cur.fetchall()]
+# Список пользователей: keyset по (messages_count, user_id) вместо OFFSET
+_users_pager = KeysetPager("users", ("messages_count", "user_id"))
 
 
-async def count_users() -> int:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cur:
-            row = await cur.fetchone()
-            return row[0] if row else 0
+async def _fetch(sql: str, params: tuple):
+    async with _pool.read() as db:
+        async with db.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+
+async def get_users_page(page: int = 0, per_page: int = 10) -> tuple[list[dict], int]:
+    """Страница пользователей по убыванию сообщений и приблизительное общее число."""
+    return await _users_pager.page(_fetch, page, per_page)
 
 
 async def find_user(query: str) -> dict | None:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         if query.isdigit():
             async with db.execute("SELECT * FROM users WHERE user_id=?", (int(query),)) as cur:
                 row = await cur.fetchone()
@@ -175,110 +479,129 @@ async def find_user(query: str) -> dict | None:
 
 
 async def get_top_users(limit: int = 10):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute("SELECT * FROM users ORDER BY messages_count DESC LIMIT ?", (limit,)) as cur:
             return [dict(r) for r in await cur.fetchall()]
 
 
 async def get_staff_users():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute("SELECT * FROM users WHERE role > 0 ORDER BY role DESC") as cur:
             return [dict(r) for r in await cur.fetchall()]
 
 
 async def get_online_users(since_seconds: int = 300):
     threshold = time.time() - since_seconds
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute("SELECT * FROM users WHERE last_seen > ?", (threshold,)) as cur:
             return [dict(r) for r in await cur.fetchall()]
 
 
+# ===================== EXPIRY =====================
+
+# (вид, флаг, колонка срока) в users; ключ планировщика — (вид, user_id)
+_EXPIRING = (("ban", "is_banned", "ban_until"), ("mute", "is_muted", "mute_until"))
+
+
+async def _expire(keys: list):
+    """Снимает флаги истёкших банов/мутов пачкой; продлённые условием по сроку не задеваются."""
+    now = time.time()
+    async with _pool.write() as db:
+        for kind, flag, column in _EXPIRING:
+            ids = [uid for k, uid in keys if k == kind]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                await db.execute(
+                    f"UPDATE users SET {flag}=0, {column}=0 WHERE {flag}=1 AND {column}>0 AND {column}<=? "
+                    f"AND user_id IN ({','.join('?' * len(chunk))})", (now, *chunk))
+
+
+_expiry = ExpiryScheduler(_expire)
+
+
 # ===================== PUNISHMENTS =====================
 
 async def add_warn(user_id: int, reason: str, issued_by: int, chat_id: int = 0) -> int:
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE users SET warns=warns+1 WHERE user_id=?", (user_id,))
+    async with _pool.write() as db:
+        async with db.execute("UPDATE users SET warns=warns+1 WHERE user_id=? RETURNING warns", (user_id,)) as cur:
+            r = await cur.fetchone()
         await db.execute(
             "INSERT INTO punishments (user_id,action,reason,issued_by,issued_at,chat_id) VALUES (?,?,?,?,?,?)",
             (user_id, "warn", reason, issued_by, now, chat_id))
-        await db.commit()
-    u = await get_user(user_id)
-    return u["warns"] if u else 1
+    return r[0] if r else 1
 
 
 async def reset_warns(user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET warns=0 WHERE user_id=?", (user_id,))
-        await db.commit()
 
 
 async def set_ban(user_id: int, until: float, reason: str, issued_by: int, chat_id: int = 0):
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET is_banned=1, ban_until=? WHERE user_id=?", (until, user_id))
         await db.execute(
             "INSERT INTO punishments (user_id,action,reason,duration,issued_by,issued_at,chat_id) VALUES (?,?,?,?,?,?,?)",
             (user_id, "ban", reason, until, issued_by, now, chat_id))
-        await db.commit()
+    _expiry.schedule(("ban", user_id), until)
 
 
 async def remove_ban(user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET is_banned=0, ban_until=0 WHERE user_id=?", (user_id,))
-        await db.commit()
+    _expiry.cancel(("ban", user_id))
 
 
 async def set_mute(user_id: int, until: float, reason: str, issued_by: int, chat_id: int = 0):
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET is_muted=1, mute_until=? WHERE user_id=?", (until, user_id))
         await db.execute(
             "INSERT INTO punishments (user_id,action,reason,duration,issued_by,issued_at,chat_id) VALUES (?,?,?,?,?,?,?)",
             (user_id, "mute", reason, until, issued_by, now, chat_id))
-        await db.commit()
+    _expiry.schedule(("mute", user_id), until)
 
 
 async def remove_mute(user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET is_muted=0, mute_until=0 WHERE user_id=?", (user_id,))
-        await db.commit()
+    _expiry.cancel(("mute", user_id))
 
 
 async def update_ban_duration(user_id: int, new_until: float):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET ban_until=? WHERE user_id=?", (new_until, user_id))
-        await db.commit()
+    _expiry.schedule(("ban", user_id), new_until)
 
 
 async def update_mute_duration(user_id: int, new_until: float):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE users SET mute_until=? WHERE user_id=?", (new_until, user_id))
-        await db.commit()
+    _expiry.schedule(("mute", user_id), new_until)
+
+
+# Все user_id из global_bans; загружается в init_db и меняется вместе с таблицей.
+_global_bans: set[int] = set()
 
 
 async def add_global_ban(user_id: int, reason: str, banned_by: int):
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT OR REPLACE INTO global_bans (user_id,reason,banned_by,banned_at) VALUES (?,?,?,?)",
             (user_id, reason, banned_by, now))
         await db.execute("UPDATE users SET is_banned=1, ban_until=0 WHERE user_id=?", (user_id,))
-        await db.commit()
+    _global_bans.add(user_id)
+    _expiry.cancel(("ban", user_id))
 
 
 async def is_global_banned(user_id: int) -> bool:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT user_id FROM global_bans WHERE user_id=?", (user_id,)) as cur:
-            return await cur.fetchone() is not None
+    return user_id in _global_bans
 
 
 async def get_user_punishments(user_id: int, limit: int = 20):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute(
             "SELECT * FROM punishments WHERE user_id=? ORDER BY issued_at DESC LIMIT ?",
             (user_id, limit)
@@ -288,8 +611,18 @@ async def get_user_punishments(user_id: int, limit: int = 20):
 
 # ===================== CHATS =====================
 
+# Строки таблицы chats в памяти: chat_id -> dict. Сбрасывается при любом изменении;
+# _chats_gen не даёт чтению, начатому до изменения, положить в кэш старую строку.
+_chats: dict[int, dict] = {}
+_chats_gen = 0
+
+
 async def ensure_chat(chat_id: int, title: str = ""):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    global _chats_gen
+    cached = _chats.get(chat_id)
+    if cached is not None and (not title or cached["title"] == title):
+        return
+    async with _pool.write() as db:
         async with db.execute("SELECT chat_id FROM chats WHERE chat_id=?", (chat_id,)) as cur:
             exists = await cur.fetchone()
         if exists:
@@ -297,76 +630,108 @@ async def ensure_chat(chat_id: int, title: str = ""):
                 await db.execute("UPDATE chats SET title=? WHERE chat_id=?", (title, chat_id))
         else:
             await db.execute("INSERT INTO chats (chat_id, title) VALUES (?,?)", (chat_id, title))
-        await db.commit()
+        async with db.execute("SELECT * FROM chats WHERE chat_id=?", (chat_id,)) as cur:
+            row = dict(await cur.fetchone())
+    # В кэш — только после коммита: при откате там не должно остаться строки
+    _chats_gen += 1
+    _chats[chat_id] = row
 
 
 async def get_chat(chat_id: int) -> dict | None:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-            row = await cur.fetchone()
-            return dict(row) if row else None
+    cached = _chats.get(chat_id)
+    if cached is None:
+        gen = _chats_gen
+        async with _pool.read() as db:
+            async with db.execute("SELECT * FROM chats WHERE chat_id=?", (chat_id,)) as cur:
+                row = await cur.fetchone()
+        if not row:
+            return None
+        cached = dict(row)
+        if gen == _chats_gen:
+            _chats[chat_id] = cached
+    return dict(cached)
 
 
 async def get_all_chats():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute("SELECT * FROM chats") as cur:
             return [dict(r) for r in await cur.fetchall()]
 
 
+async def _set_chat_flag(chat_id: int, column: str, enabled: bool):
+    global _chats_gen
+    async with _pool.write() as db:
+        await db.execute(f"UPDATE chats SET {column}=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
+    _chats_gen += 1
+    _chats.pop(chat_id, None)
+
+
 async def set_chat_read_only(chat_id: int, enabled: bool):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE chats SET read_only=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await db.commit()
+    await _set_chat_flag(chat_id, "read_only", enabled)
 
 
 async def set_chat_antispam(chat_id: int, enabled: bool):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE chats SET antispam=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await db.commit()
+    await _set_chat_flag(chat_id, "antispam", enabled)
 
 
 async def set_chat_ai_moderation(chat_id: int, enabled: bool):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE chats SET ai_moderation=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await db.commit()
+    await _set_chat_flag(chat_id, "ai_moderation", enabled)
 
 
 # ===================== WORD FILTERS =====================
 
+# Скомпилированные фильтры: chat_id -> WordMatcher, сбрасываются при add/remove.
+# _word_matchers_gen — как _chats_gen: матчер, собранный до правки списка, в кэш не попадёт.
+_word_matchers: dict[int, WordMatcher] = {}
+_word_matchers_gen = 0
+
+
+def _forget_word_matcher(chat_id: int):
+    global _word_matchers_gen
+    _word_matchers_gen += 1
+    _word_matchers.pop(chat_id, None)
+
+
 async def add_word_filter(chat_id: int, word: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("INSERT INTO word_filters (chat_id, word) VALUES (?,?)", (chat_id, word.lower()))
-        await db.commit()
+    _forget_word_matcher(chat_id)
 
 
 async def remove_word_filter(chat_id: int, word: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("DELETE FROM word_filters WHERE chat_id=? AND word=?", (chat_id, word.lower()))
-        await db.commit()
+    _forget_word_matcher(chat_id)
 
 
 async def get_word_filters(chat_id: int) -> list[str]:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.read() as db:
         async with db.execute("SELECT word FROM word_filters WHERE chat_id=?", (chat_id,)) as cur:
             return [r[0] for r in await cur.fetchall()]
 
 
+async def get_word_filter_matcher(chat_id: int) -> WordMatcher:
+    matcher = _word_matchers.get(chat_id)
+    if matcher is None:
+        gen = _word_matchers_gen
+        matcher = WordMatcher(await get_word_filters(chat_id))
+        if gen == _word_matchers_gen:
+            _word_matchers[chat_id] = matcher
+    return matcher
+
+
 # ===================== REPORTS =====================
 
 async def add_report(reporter_id: int, reported_id: int, reason: str, chat_id: int = 0):
     now = time.time()
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute(
             "INSERT INTO reports (reporter_id,reported_id,reason,chat_id,created_at) VALUES (?,?,?,?,?)",
             (reporter_id, reported_id, reason, chat_id, now))
-        await db.commit()
 
 
 async def get_open_reports(limit: int = 20):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _pool.read() as db:
         async with db.execute(
             "SELECT * FROM reports WHERE status='open' ORDER BY created_at DESC LIMIT ?", (limit,)
         ) as cur:
@@ -374,6 +739,36 @@ async def get_open_reports(limit: int = 20):
 
 
 async def close_report(report_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.write() as db:
         await db.execute("UPDATE reports SET status='closed' WHERE id=?", (report_id,))
-        await db.commit()
+
+
+# ===================== STAFF OUTBOX =====================
+# Очередь логов стафф-чата: staff_log пишет сюда, фоновый отправщик
+# забирает строки по порядку id и удаляет после успешной отправки.
+
+async def enqueue_staff_log(topic_id: int, text: str) -> int:
+    async with _pool.write() as db:
+        cur = await db.execute(
+            "INSERT INTO staff_outbox (topic_id,text,created_at) VALUES (?,?,?)",
+            (topic_id, text, time.time()))
+        return cur.lastrowid
+
+
+async def get_staff_outbox(limit: int = 200):
+    async with _pool.read() as db:
+        async with db.execute(
+            "SELECT * FROM staff_outbox ORDER BY id LIMIT ?", (limit,)
+        ) as cur:
+            return [dict(r) for r in await cur.fetchall()]
+
+
+async def delete_staff_log(entry_id: int):
+    async with _pool.write() as db:
+        await db.execute("DELETE FROM staff_outbox WHERE id=?", (entry_id,))
+
+
+async def defer_staff_log(entry_id: int, next_at: float):
+    async with _pool.write() as db:
+        await db.execute(
+            "UPDATE staff_outbox SET attempts=attempts+1, next_at=? WHERE id=?", (next_at, entry_id))
@@ -1,17 +1,65 @@
 """Database module v8.1 — полный рефакторинг"""
 
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import aiosqlite
-from typing import Optional, List, Dict, Tuple
+from typing import Callable, Optional, List, Dict, Tuple
 import time
 import logging
 
+from wordfilter import WordMatcher
+from pagination import KeysetPager
+from queryplan import check_query_plans
+from expiry import ExpiryScheduler
+import migrations
+
 logger = logging.getLogger(__name__)
 
 
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, flush_interval: float = 1.0, flush_rows: int = 500):
         self.db_path = db_path
         self.db: Optional[aiosqlite.Connection] = None
+        # Write-behind: счётчики сообщений копятся в памяти и пишутся пачкой
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._pending_counts: Dict[Tuple[int, int], int] = {}
+        # Username и регистрации тоже пишутся с буфером, и только если изменились:
+        # _known_* — то, что точно уже лежит в базе (сбрасывается при переполнении)
+        self._pending_usernames: Dict[int, Tuple[str, int]] = {}
+        self._pending_regs: Dict[Tuple[int, int], int] = {}
+        self._known_usernames: Dict[int, str] = {}
+        self._known_regs: set = set()
+        self.known_max = 200_000
+        self._flush_task: Optional[asyncio.Task] = None
+        self._migrate_task: Optional[asyncio.Task] = None
+        # Запись и transaction(): задача-владелец открытой транзакции
+        self._write_lock = asyncio.Lock()
+        self._tx_owner: Optional[asyncio.Task] = None
+        # Правки кэшей, отложенные до коммита внешней транзакции (см. _on_commit)
+        self._after_commit: List[Callable[[], None]] = []
+        # Настройки чатов: chat_id -> dict, сбрасывается сеттерами
+        self._chat_settings: Dict[int, dict] = {}
+        self._chat_settings_gen = 0
+        # Скомпилированные банворды: chat_id -> WordMatcher
+        self._banword_matchers: Dict[int, WordMatcher] = {}
+        # Все глобально забаненные user_id; загружается в init()
+        self._global_bans: set = set()
+        # Итоговая роль (глобальная или чатовая): (user_id, chat_id) -> role, LRU
+        self._role_cache: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self._role_gen = 0
+        self.role_cache_max = 100_000
+        self.role_hits = 0
+        self.role_misses = 0
+        # Списки /banlist, /warnlist: keyset по (время, rowid)
+        self._bans_pager = KeysetPager("bans", ("banned_at", "rowid"))
+        self._gbans_pager = KeysetPager("global_bans", ("banned_at", "rowid"))
+        self._warns_pager = KeysetPager("warns", ("warned_at", "rowid"))
+        # Сроки временных мутов/банов: ключ ("mute"|"ban", user_id, chat_id).
+        # on_expire(kind, [(user_id, chat_id), ...]) вызывается после удаления строк
+        self.expiry = ExpiryScheduler(self._expire)
+        self.on_expire = None
 
     async def init(self):
         self.db = await aiosqlite.connect(self.db_path)
@@ -20,11 +68,115 @@ class Database:
         await self.db.execute("PRAGMA busy_timeout=5000")
         await self._create_tables()
         await self._migrate()
+        async with self.db.execute("SELECT user_id FROM global_bans") as cur:
+            self._global_bans = {r[0] for r in await cur.fetchall()}
+        await self._warm_roles()
+        for kind, table in (("mute", "mutes"), ("ban", "bans")):
+            async with self.db.execute(f"SELECT user_id, chat_id, until FROM {table} WHERE until>0") as cur:
+                self.expiry.load(((kind, r[0], r[1]), r[2]) for r in await cur.fetchall())
+        self.expiry.start()
+        self._flush_task = asyncio.create_task(self._flush_loop())
 
     async def close(self):
+        await self.expiry.close()
+        if self._migrate_task:
+            self._migrate_task.cancel()
+            try: await self._migrate_task
+            except (asyncio.CancelledError, Exception): pass
+            self._migrate_task = None
+        if self._flush_task:
+            # Дожидаемся отмены: прерванный flush вернёт пачку в буфер до финального
+            self._flush_task.cancel()
+            try: await self._flush_task
+            except asyncio.CancelledError: pass
+            self._flush_task = None
         if self.db:
+            try: await self.flush()
+            except Exception as e: logger.warning(f"flush on close: {e}")
             await self.db.close()
 
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try: await self.flush()
+            except Exception as e: logger.warning(f"flush: {e}")
+
+    # === ТРАНЗАКЦИИ ===
+    # Соединение одно, поэтому каждая запись идёт под _write_lock: иначе
+    # commit одной корутины зафиксировал бы половину чужой транзакции.
+    @asynccontextmanager
+    async def _writing(self):
+        """Запись с коммитом на выходе; внутри transaction() той же задачи — без коммита."""
+        task = asyncio.current_task()
+        if self._tx_owner is task:
+            yield self.db
+            return
+        async with self._write_lock:
+            self._tx_owner = task
+            try:
+                yield self.db
+                await self.db.commit()
+            except BaseException:
+                await self.db.rollback()
+                self._after_commit.clear()
+                raise
+            finally:
+                self._tx_owner = None
+            callbacks, self._after_commit = self._after_commit, []
+            for fn in callbacks: fn()
+
+    def _on_commit(self, fn):
+        """Вызывается после блока _writing(): внутри transaction() откладывает fn
+        до коммита внешнего блока, при откате fn не вызывается вовсе."""
+        if self._tx_owner is asyncio.current_task():
+            self._after_commit.append(fn)
+        else:
+            fn()
+
+    def transaction(self):
+        """Единица работы: вызовы методов записи внутри блока коммитятся один раз
+        на выходе, при исключении всё откатывается.
+
+            async with db.transaction():
+                n = await db.add_warn(...)
+                if n >= MAX_WARNS: await db.clear_warns(...)
+
+        Внутри блока не ждать сеть: остальные записи стоят на блокировке.
+        """
+        return self._writing()
+
+    def _pending_rows(self):
+        return len(self._pending_counts) + len(self._pending_usernames) + len(self._pending_regs)
+
+    async def flush(self):
+        """Сбрасывает буферы (счётчики, username, регистрации) одной транзакцией."""
+        if not self._pending_rows(): return
+        batch, self._pending_counts = self._pending_counts, {}
+        names, self._pending_usernames = self._pending_usernames, {}
+        regs, self._pending_regs = self._pending_regs, {}
+        try:
+            async with self._writing():
+                if batch:
+                    await self.db.executemany("INSERT INTO message_counts (user_id,chat_id,count) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET count=count+excluded.count", [(u, c, n) for (u, c), n in batch.items()])
+                if names:
+                    await self.db.executemany("INSERT INTO username_cache (user_id,username,updated_at) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, updated_at=excluded.updated_at", [(u, n, t) for u, (n, t) in names.items()])
+                if regs:
+                    await self.db.executemany("INSERT OR IGNORE INTO user_reg (user_id,chat_id,reg_at) VALUES (?,?,?)", [(u, c, t) for (u, c), t in regs.items()])
+        except BaseException:
+            # В том числе CancelledError на остановке — пачка не должна пропасть
+            for key, n in batch.items():
+                self._pending_counts[key] = self._pending_counts.get(key, 0) + n
+            for u, v in names.items():
+                self._pending_usernames.setdefault(u, v)
+            for key, t in regs.items():
+                self._pending_regs.setdefault(key, t)
+            raise
+        if len(self._known_usernames) + len(names) > self.known_max: self._known_usernames.clear()
+        if len(self._known_regs) + len(regs) > self.known_max: self._known_regs.clear()
+        for u, (n, _) in names.items():
+            self._known_usernames[u] = n
+        self._known_regs.update(regs)
+
     async def _create_tables(self):
         await self.db.executescript("""
             CREATE TABLE IF NOT EXISTS chats (
@@ -108,30 +260,71 @@ class Database:
                 accepted_by INTEGER DEFAULT 0,
                 created_at INTEGER DEFAULT (strftime('%s', 'now'))
             );
-            CREATE TABLE IF NOT EXISTS spam_track (
-                user_id INTEGER, chat_id INTEGER, ts INTEGER,
-                PRIMARY KEY (user_id, chat_id)
-            );
-            CREATE INDEX IF NOT EXISTS idx_uname_cache ON username_cache(username);
-            CREATE INDEX IF NOT EXISTS idx_msg_counts ON message_counts(chat_id, count);
         """)
         await self.db.commit()
 
-    async def _migrate(self):
+    # === МИГРАЦИИ ===
+    # Новые изменения схемы — только сюда, с новым номером версии.
+    # online=True: индексы и backfill, идут в фоне после старта.
+    _MIGRATIONS = [
+        {"version": 1, "name": "chats.quiet_mode", "apply": migrations.add_column("chats", "quiet_mode", "INTEGER DEFAULT 0")},
+        {"version": 2, "name": "chats.filter", "apply": migrations.add_column("chats", "filter", "INTEGER DEFAULT 0")},
+        {"version": 3, "name": "chats.antiflood", "apply": migrations.add_column("chats", "antiflood", "INTEGER DEFAULT 0")},
+        {"version": 4, "name": "idx_msg_counts", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_msg_counts ON message_counts(chat_id, count)")},
+        {"version": 5, "name": "idx_uname_cache_time", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_uname_cache_time ON username_cache(username, updated_at)",
+                                     "DROP INDEX IF EXISTS idx_uname_cache")},
+        {"version": 6, "name": "idx_bans_time", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_bans_time ON bans(banned_at)",
+                                     "CREATE INDEX IF NOT EXISTS idx_bans_chat_time ON bans(chat_id, banned_at)",
+                                     "CREATE INDEX IF NOT EXISTS idx_gbans_time ON global_bans(banned_at)")},
+        {"version": 7, "name": "idx_warns_time", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_warns_time ON warns(warned_at)",
+                                     "CREATE INDEX IF NOT EXISTS idx_warns_chat_time ON warns(chat_id, warned_at)")},
+        {"version": 8, "name": "idx_reports_status", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status, created_at)")},
+        {"version": 9, "name": "idx_nicks", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_nicks_nick ON nicks(nick COLLATE NOCASE)",
+                                     "CREATE INDEX IF NOT EXISTS idx_nicks_chat ON nicks(chat_id, nick)")},
+        {"version": 10, "name": "idx_global_roles_role", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_global_roles_role ON global_roles(role)")},
+        {"version": 11, "name": "idx_action_cache_time", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_action_cache_time ON action_cache(cached_at)")},
+        {"version": 12, "name": "idx_until", "online": True,
+         "apply": migrations.execute("CREATE INDEX IF NOT EXISTS idx_mutes_until ON mutes(until) WHERE until>0",
+                                     "CREATE INDEX IF NOT EXISTS idx_bans_until ON bans(until) WHERE until>0")},
+    ]
+
+    @asynccontextmanager
+    async def _main_conn(self):
         try:
-            async with self.db.execute("PRAGMA table_info(chats)") as cur:
-                cols = [row[1] for row in await cur.fetchall()]
-            for col, default in [("quiet_mode", 0), ("filter", 0), ("antiflood", 0)]:
-                if col not in cols:
-                    await self.db.execute(f"ALTER TABLE chats ADD COLUMN {col} INTEGER DEFAULT {default}")
+            yield self.db
             await self.db.commit()
-        except Exception as e:
-            logger.warning(f"migrate: {e}")
+        except BaseException:
+            # Иначе упавший шаг миграции оставит открытую транзакцию, и её закоммитит следующая запись
+            await self.db.rollback()
+            raise
+
+    async def _migrate(self):
+        """Обычные миграции на старте; online — в фоне, после запуска бота."""
+        pending = await migrations.run_startup(self._main_conn, self._MIGRATIONS)
+        self._migrate_task = asyncio.create_task(self._migrate_online(pending))
+
+    async def _migrate_online(self, pending):
+        # Каждый шаг — под _writing() на основном соединении: остальные записи
+        # ждут на блокировке, а не падают по busy_timeout. Индекс — одно короткое
+        # эксклюзивное окно, backfill коммитится пачками и отпускает блокировку
+        await migrations.run_online(self._writing, pending)
+        # Под той же блокировкой: открытый EXPLAIN-курсор не даст закоммитить чужую запись
+        async with self._writing():
+            await check_query_plans(self.db, self._HOT_QUERIES)
 
     # === ЧАТЫ ===
     async def register_chat(self, chat_id, title=""):
-        await self.db.execute("INSERT INTO chats (chat_id, title) VALUES (?,?) ON CONFLICT(chat_id) DO UPDATE SET title=excluded.title", (chat_id, title))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO chats (chat_id, title) VALUES (?,?) ON CONFLICT(chat_id) DO UPDATE SET title=excluded.title", (chat_id, title))
+        self._on_commit(lambda: self._forget_chat_settings(chat_id))
 
     async def get_all_chat_ids(self):
         async with self.db.execute("SELECT chat_id FROM chats") as cur:
@@ -142,24 +335,36 @@ class Database:
             r = await cur.fetchone()
             return r[0] if r else str(chat_id)
 
+    async def get_chat_titles(self):
+        async with self.db.execute("SELECT chat_id, title FROM chats") as cur:
+            return {r[0]: r[1] or str(r[0]) for r in await cur.fetchall()}
+
     async def get_chat_count(self):
         async with self.db.execute("SELECT COUNT(*) FROM chats") as cur:
             return (await cur.fetchone())[0]
 
     # === USERNAME CACHE ===
     async def cache_username(self, user_id, username):
+        """В буфер, только если username изменился; в базу — с ближайшим flush()."""
         if not username: return
         username = username.lower().lstrip("@")
-        await self.db.execute("INSERT INTO username_cache (user_id,username,updated_at) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, updated_at=excluded.updated_at", (user_id, username, int(time.time())))
-        await self.db.commit()
+        pending = self._pending_usernames.get(user_id)
+        if (pending[0] if pending else self._known_usernames.get(user_id)) == username: return
+        self._pending_usernames[user_id] = (username, int(time.time()))
+        if self._pending_rows() >= self.flush_rows:
+            await self.flush()
 
     async def get_user_by_username(self, username):
         username = username.lower().lstrip("@")
+        for uid, (name, _) in self._pending_usernames.items():
+            if name == username: return uid
         async with self.db.execute("SELECT user_id FROM username_cache WHERE username=? COLLATE NOCASE ORDER BY updated_at DESC LIMIT 1", (username,)) as cur:
             r = await cur.fetchone()
             return r[0] if r else None
 
     async def get_username_by_id(self, user_id):
+        pending = self._pending_usernames.get(user_id)
+        if pending: return pending[0]
         async with self.db.execute("SELECT username FROM username_cache WHERE user_id=?", (user_id,)) as cur:
             r = await cur.fetchone()
             if r and r[0]: return r[0]
@@ -169,9 +374,10 @@ class Database:
 
     # === РОЛИ ===
     async def set_global_role(self, user_id, role, username=None):
-        await self.db.execute("INSERT INTO global_roles (user_id,username,role) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET role=excluded.role, username=COALESCE(excluded.username, global_roles.username)", (user_id, username, role))
-        await self.db.commit()
-        if username: await self.cache_username(user_id, username)
+        async with self._writing():
+            await self.db.execute("INSERT INTO global_roles (user_id,username,role) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET role=excluded.role, username=COALESCE(excluded.username, global_roles.username)", (user_id, username, role))
+            if username: await self.cache_username(user_id, username)
+        self._on_commit(lambda: self._forget_roles(user_id))
 
     async def get_global_role(self, user_id):
         async with self.db.execute("SELECT role FROM global_roles WHERE user_id=?", (user_id,)) as cur:
@@ -183,11 +389,13 @@ class Database:
             return [(r[0], r[1]) for r in await cur.fetchall()]
 
     async def set_user_role(self, user_id, chat_id, role):
-        if role == 0:
-            await self.db.execute("DELETE FROM user_roles WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        else:
-            await self.db.execute("INSERT INTO user_roles (user_id,chat_id,role) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET role=excluded.role", (user_id, chat_id, role))
-        await self.db.commit()
+        async with self._writing():
+            if role == 0:
+                await self.db.execute("DELETE FROM user_roles WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+            else:
+                await self.db.execute("INSERT INTO user_roles (user_id,chat_id,role) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET role=excluded.role", (user_id, chat_id, role))
+        # Кэш сбрасываем после коммита, иначе get_role успеет положить туда старую роль
+        self._on_commit(lambda: self._forget_role(user_id, chat_id))
 
     async def get_user_role(self, user_id, chat_id):
         async with self.db.execute("SELECT role FROM user_roles WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
@@ -195,22 +403,65 @@ class Database:
             return r[0] if r else 0
 
     async def remove_all_user_roles(self, user_id):
-        await self.db.execute("DELETE FROM user_roles WHERE user_id=?", (user_id,))
-        await self.db.execute("DELETE FROM global_roles WHERE user_id=?", (user_id,))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM user_roles WHERE user_id=?", (user_id,))
+            await self.db.execute("DELETE FROM global_roles WHERE user_id=?", (user_id,))
+        self._on_commit(lambda: self._forget_roles(user_id))
+
+    async def get_role(self, user_id, chat_id=0):
+        """Глобальная роль, а если её нет — роль в чате. Кэшируется по (user_id, chat_id)."""
+        key = (user_id, chat_id)
+        role = self._role_cache.get(key)
+        if role is not None:
+            self.role_hits += 1
+            self._role_cache.move_to_end(key)
+            return role
+        self.role_misses += 1
+        gen = self._role_gen
+        role = await self.get_global_role(user_id)
+        if role <= 0:
+            role = await self.get_user_role(user_id, chat_id) if chat_id else 0
+        if gen == self._role_gen:
+            self._remember_role(key, role)
+        return role
+
+    def role_cache_stats(self):
+        return {"size": len(self._role_cache), "hits": self.role_hits, "misses": self.role_misses}
+
+    def _remember_role(self, key, role):
+        self._role_cache[key] = role
+        self._role_cache.move_to_end(key)
+        while len(self._role_cache) > self.role_cache_max:
+            self._role_cache.popitem(last=False)
+
+    def _forget_role(self, user_id, chat_id):
+        self._role_gen += 1
+        self._role_cache.pop((user_id, chat_id), None)
+
+    def _forget_roles(self, user_id):
+        self._role_gen += 1
+        for key in [k for k in self._role_cache if k[0] == user_id]:
+            del self._role_cache[key]
+
+    async def _warm_roles(self):
+        chat_ids = [0] + await self.get_all_chat_ids()
+        for uid, role in await self.get_all_staff():
+            for cid in chat_ids:
+                self._remember_role((uid, cid), role)
 
     # === ГЛОБАЛЬНЫЙ БАН ===
     async def add_global_ban(self, user_id, banned_by, reason):
-        await self.db.execute("INSERT INTO global_bans (user_id,banned_by,reason) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET banned_by=excluded.banned_by, reason=excluded.reason, banned_at=strftime('%s','now')", (user_id, banned_by, reason))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO global_bans (user_id,banned_by,reason) VALUES (?,?,?) ON CONFLICT(user_id) DO UPDATE SET banned_by=excluded.banned_by, reason=excluded.reason, banned_at=strftime('%s','now')", (user_id, banned_by, reason))
+        self._on_commit(lambda: self._global_bans.add(user_id))
 
     async def remove_global_ban(self, user_id):
-        await self.db.execute("DELETE FROM global_bans WHERE user_id=?", (user_id,))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM global_bans WHERE user_id=?", (user_id,))
+        self._on_commit(lambda: self._global_bans.discard(user_id))
 
     async def is_globally_banned(self, user_id):
-        async with self.db.execute("SELECT 1 FROM global_bans WHERE user_id=?", (user_id,)) as cur:
-            return await cur.fetchone() is not None
+        return user_id in self._global_bans
 
     async def get_global_ban_info(self, user_id):
         async with self.db.execute("SELECT * FROM global_bans WHERE user_id=?", (user_id,)) as cur:
@@ -219,15 +470,17 @@ class Database:
 
     # === БАНЫ ===
     async def add_ban(self, user_id, chat_id, banned_by, reason, until=0):
-        await self.db.execute("INSERT INTO bans (user_id,chat_id,banned_by,reason,until) VALUES (?,?,?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET banned_by=excluded.banned_by, reason=excluded.reason, until=excluded.until, banned_at=strftime('%s','now')", (user_id, chat_id, banned_by, reason, until))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO bans (user_id,chat_id,banned_by,reason,until) VALUES (?,?,?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET banned_by=excluded.banned_by, reason=excluded.reason, until=excluded.until, banned_at=strftime('%s','now')", (user_id, chat_id, banned_by, reason, until))
+        self.expiry.schedule(("ban", user_id, chat_id), until)
 
     async def remove_ban(self, user_id, chat_id):
-        await self.db.execute("DELETE FROM bans WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM bans WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+        self.expiry.cancel(("ban", user_id, chat_id))
 
     async def is_banned(self, user_id, chat_id):
-        async with self.db.execute("SELECT 1 FROM bans WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
+        async with self.db.execute("SELECT 1 FROM bans WHERE user_id=? AND chat_id=? AND (until=0 OR until>?)", (user_id, chat_id, int(time.time()))) as cur:
             return await cur.fetchone() is not None
 
     async def get_ban_info(self, user_id, chat_id):
@@ -235,43 +488,52 @@ class Database:
             r = await cur.fetchone()
             return dict(r) if r else None
 
+    async def _fetch(self, sql, params):
+        async with self.db.execute(sql, params) as cur:
+            return await cur.fetchall()
+
     async def get_all_bans_paginated(self, page=0, per_page=5, chat_id=0):
-        offset = page * per_page
-        q = "WHERE chat_id=?" if chat_id else ""
-        p = (chat_id,) if chat_id else ()
-        async with self.db.execute(f"SELECT COUNT(*) FROM bans {q}", p) as cur:
-            total = (await cur.fetchone())[0]
-        async with self.db.execute(f"SELECT * FROM bans {q} ORDER BY banned_at DESC LIMIT ? OFFSET ?", p + (per_page, offset)) as cur:
-            rows = [dict(r) for r in await cur.fetchall()]
-        return rows, total
+        if chat_id:
+            return await self._bans_pager.page(self._fetch, page, per_page, "chat_id=?", (chat_id,))
+        return await self._bans_pager.page(self._fetch, page, per_page)
 
     async def get_all_global_bans_paginated(self, page=0, per_page=5):
-        offset = page * per_page
-        async with self.db.execute("SELECT COUNT(*) FROM global_bans") as cur:
-            total = (await cur.fetchone())[0]
-        async with self.db.execute("SELECT * FROM global_bans ORDER BY banned_at DESC LIMIT ? OFFSET ?", (per_page, offset)) as cur:
-            rows = [dict(r) for r in await cur.fetchall()]
-        return rows, total
+        return await self._gbans_pager.page(self._fetch, page, per_page)
 
     # === МУТЫ ===
     async def add_mute(self, user_id, chat_id, muted_by, reason, until):
-        await self.db.execute("INSERT INTO mutes (user_id,chat_id,muted_by,reason,until) VALUES (?,?,?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET muted_by=excluded.muted_by, reason=excluded.reason, until=excluded.until, muted_at=strftime('%s','now')", (user_id, chat_id, muted_by, reason, until))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO mutes (user_id,chat_id,muted_by,reason,until) VALUES (?,?,?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET muted_by=excluded.muted_by, reason=excluded.reason, until=excluded.until, muted_at=strftime('%s','now')", (user_id, chat_id, muted_by, reason, until))
+        self.expiry.schedule(("mute", user_id, chat_id), until)
 
     async def remove_mute(self, user_id, chat_id):
-        await self.db.execute("DELETE FROM mutes WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM mutes WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+        self.expiry.cancel(("mute", user_id, chat_id))
 
     async def is_muted(self, user_id, chat_id):
-        now = int(time.time())
+        """Без побочных эффектов: истёкшие строки удаляет планировщик (_expire)."""
         async with self.db.execute("SELECT until FROM mutes WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
             r = await cur.fetchone()
-            if not r: return False
-            until = r[0]
-            if until == 0: return True
-            if until > now: return True
-            await self.remove_mute(user_id, chat_id)
-            return False
+            return r is not None and (not r[0] or r[0] > time.time())
+
+    async def _expire(self, keys):
+        """Удаляет истёкшие муты/баны пачкой; условие по until защищает от свежего продления."""
+        now = int(time.time())
+        gone = {"mute": [], "ban": []}
+        async with self._writing():
+            for kind, table in (("mute", "mutes"), ("ban", "bans")):
+                pairs = [(u, c) for k, u, c in keys if k == kind]
+                for i in range(0, len(pairs), 400):
+                    chunk = pairs[i:i + 400]
+                    q = f"DELETE FROM {table} WHERE until>0 AND until<=? AND (user_id, chat_id) IN (VALUES {','.join(['(?,?)'] * len(chunk))}) RETURNING user_id, chat_id"
+                    async with self.db.execute(q, (now, *(x for p in chunk for x in p))) as cur:
+                        gone[kind].extend((r[0], r[1]) for r in await cur.fetchall())
+        if self.on_expire:
+            for kind, pairs in gone.items():
+                if pairs:
+                    try: await self.on_expire(kind, pairs)
+                    except Exception as e: logger.warning(f"on_expire: {e}")
 
     async def get_mute_info(self, user_id, chat_id):
         async with self.db.execute("SELECT * FROM mutes WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
@@ -280,26 +542,20 @@ class Database:
 
     # === ВАРНЫ ===
     async def add_warn(self, user_id, chat_id, warned_by, reason):
-        async with self.db.execute("SELECT count FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
-            r = await cur.fetchone()
-            current = r[0] if r else 0
-        nc = current + 1
-        await self.db.execute("INSERT INTO warns (user_id,chat_id,count,warned_by,reason) VALUES (?,?,?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET count=excluded.count, warned_by=excluded.warned_by, reason=excluded.reason, warned_at=strftime('%s','now')", (user_id, chat_id, nc, warned_by, reason))
-        await self.db.commit()
-        return nc
+        """Атомарный +1; возвращает новое число варнов."""
+        async with self._writing():
+            async with self.db.execute("INSERT INTO warns (user_id,chat_id,count,warned_by,reason) VALUES (?,?,1,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET count=warns.count+1, warned_by=excluded.warned_by, reason=excluded.reason, warned_at=strftime('%s','now') RETURNING count", (user_id, chat_id, warned_by, reason)) as cur:
+                return (await cur.fetchone())[0]
 
     async def remove_warn(self, user_id, chat_id):
-        async with self.db.execute("SELECT count FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
-            r = await cur.fetchone()
-            current = r[0] if r else 0
-        if current <= 0: return 0
-        nc = current - 1
-        if nc == 0:
-            await self.db.execute("DELETE FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        else:
-            await self.db.execute("UPDATE warns SET count=? WHERE user_id=? AND chat_id=?", (nc, user_id, chat_id))
-        await self.db.commit()
-        return nc
+        """Атомарный -1 (не ниже нуля); возвращает новое число варнов."""
+        async with self._writing():
+            async with self.db.execute("UPDATE warns SET count=count-1 WHERE user_id=? AND chat_id=? AND count>0 RETURNING count", (user_id, chat_id)) as cur:
+                r = await cur.fetchone()
+            if r is None: return 0
+            if r[0] == 0:
+                await self.db.execute("DELETE FROM warns WHERE user_id=? AND chat_id=? AND count<=0", (user_id, chat_id))
+            return r[0]
 
     async def get_warns(self, user_id, chat_id):
         async with self.db.execute("SELECT count FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
@@ -312,38 +568,97 @@ class Database:
             return dict(r) if r else None
 
     async def clear_warns(self, user_id, chat_id):
-        await self.db.execute("DELETE FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM warns WHERE user_id=? AND chat_id=?", (user_id, chat_id))
 
     async def get_all_warns_paginated(self, page=0, per_page=5, chat_id=0):
-        offset = page * per_page
-        q = "WHERE chat_id=? AND count>0" if chat_id else "WHERE count>0"
-        p = (chat_id,) if chat_id else ()
-        async with self.db.execute(f"SELECT COUNT(*) FROM warns {q}", p) as cur:
-            total = (await cur.fetchone())[0]
-        async with self.db.execute(f"SELECT * FROM warns {q} ORDER BY warned_at DESC LIMIT ? OFFSET ?", p + (per_page, offset)) as cur:
-            rows = [dict(r) for r in await cur.fetchall()]
-        return rows, total
-
-    async def get_user_all_punishments(self, user_id):
-        result = {"warns": [], "mutes": [], "bans": [], "global_ban": None}
-        async with self.db.execute("SELECT * FROM warns WHERE user_id=? AND count>0", (user_id,)) as cur:
-            result["warns"] = [dict(r) for r in await cur.fetchall()]
+        if chat_id:
+            return await self._warns_pager.page(self._fetch, page, per_page, "chat_id=? AND count>0", (chat_id,))
+        return await self._warns_pager.page(self._fetch, page, per_page, "count>0")
+
+    _DOSSIER_SQL = """
+        SELECT 'warn' AS kind, w.chat_id, w.count AS n, w.reason, w.warned_at AS at, w.warned_by AS by, c.title
+          FROM warns w LEFT JOIN chats c ON c.chat_id=w.chat_id WHERE w.user_id=:uid AND w.count>0
+        UNION ALL
+        SELECT 'mute', m.chat_id, m.until, m.reason, m.muted_at, m.muted_by, c.title
+          FROM mutes m LEFT JOIN chats c ON c.chat_id=m.chat_id WHERE m.user_id=:uid
+        UNION ALL
+        SELECT 'ban', b.chat_id, b.until, b.reason, b.banned_at, b.banned_by, c.title
+          FROM bans b LEFT JOIN chats c ON c.chat_id=b.chat_id WHERE b.user_id=:uid
+        UNION ALL
+        SELECT 'gban', 0, 0, g.reason, g.banned_at, g.banned_by, NULL
+          FROM global_bans g WHERE g.user_id=:uid
+        UNION ALL
+        SELECT 'msgs', mc.chat_id, mc.count, NULL, NULL, NULL, c.title
+          FROM message_counts mc LEFT JOIN chats c ON c.chat_id=mc.chat_id WHERE mc.user_id=:uid
+        UNION ALL
+        SELECT 'reg', r.chat_id, 0, NULL, r.reg_at, NULL, c.title
+          FROM user_reg r LEFT JOIN chats c ON c.chat_id=r.chat_id WHERE r.user_id=:uid
+    """
+
+    # Запросы, которые не должны деградировать до полного прохода по таблице
+    _HOT_QUERIES = {
+        "chat_settings": ("SELECT ro_mode, quiet_mode, antiflood, filter, welcome_text FROM chats WHERE chat_id=?", (0,)),
+        "global_role": ("SELECT role FROM global_roles WHERE user_id=?", (0,)),
+        "chat_role": ("SELECT role FROM user_roles WHERE user_id=? AND chat_id=?", (0, 0)),
+        "all_staff": ("SELECT user_id, role FROM global_roles WHERE role>0 ORDER BY role DESC", ()),
+        "banwords": ("SELECT word FROM banwords WHERE chat_id=?", (0,)),
+        "message_count": ("SELECT count FROM message_counts WHERE user_id=? AND chat_id=?", (0, 0)),
+        "top_messagers": ("SELECT user_id, count FROM message_counts WHERE chat_id=? ORDER BY count DESC LIMIT ?", (0, 10)),
+        "user_by_username": ("SELECT user_id FROM username_cache WHERE username=? COLLATE NOCASE ORDER BY updated_at DESC LIMIT 1", ("",)),
+        "nick_in_chat": ("SELECT user_id FROM nicks WHERE nick=? COLLATE NOCASE AND chat_id=?", ("", 0)),
+        "nick_any_chat": ("SELECT user_id FROM nicks WHERE nick=? COLLATE NOCASE LIMIT 1", ("",)),
+        "chat_nicks": ("SELECT user_id, nick FROM nicks WHERE chat_id=? ORDER BY nick", (0,)),
+        "open_reports": ("SELECT * FROM reports WHERE status='open' ORDER BY created_at DESC LIMIT ?", (20,)),
+        "bans_page": ("SELECT rowid AS _key, * FROM bans WHERE chat_id=? AND (banned_at, rowid) < (?, ?) "
+                      "ORDER BY banned_at DESC, rowid DESC LIMIT ?", (0, 0, 0, 5)),
+        "gbans_page": ("SELECT rowid AS _key, * FROM global_bans WHERE 1 AND (banned_at, rowid) < (?, ?) "
+                       "ORDER BY banned_at DESC, rowid DESC LIMIT ?", (0, 0, 5)),
+        "warns_page": ("SELECT rowid AS _key, * FROM warns WHERE chat_id=? AND count>0 AND (warned_at, rowid) < (?, ?) "
+                       "ORDER BY warned_at DESC, rowid DESC LIMIT ?", (0, 0, 0, 5)),
+        "dossier": (_DOSSIER_SQL, {"uid": 0}),
+        "cache_cleanup": ("DELETE FROM action_cache WHERE cached_at<?", (0,)),
+    }
+
+    async def get_user_dossier(self, user_id):
+        """Всё о пользователе одним запросом: наказания, сообщения, регистрации.
+
+        bans/mutes/warns — списки dict с chat_id и title; bans и mutes включают
+        истёкшие (поле active); messages/reg — {chat_id: значение}.
+        """
         now = int(time.time())
-        async with self.db.execute("SELECT * FROM mutes WHERE user_id=?", (user_id,)) as cur:
-            for r in await cur.fetchall():
-                d = dict(r)
-                if d["until"] == 0 or d["until"] > now:
-                    result["mutes"].append(d)
-        async with self.db.execute("SELECT * FROM bans WHERE user_id=?", (user_id,)) as cur:
-            result["bans"] = [dict(r) for r in await cur.fetchall()]
-        result["global_ban"] = await self.get_global_ban_info(user_id)
-        return result
+        d = {"user_id": user_id, "global_ban": None, "bans": [], "mutes": [], "warns": [],
+             "messages": {}, "messages_total": 0, "reg": {}}
+        async with self.db.execute(self._DOSSIER_SQL, {"uid": user_id}) as cur:
+            rows = await cur.fetchall()
+        for kind, chat_id, n, reason, at, by, title in rows:
+            title = title or str(chat_id)
+            if kind == "warn":
+                d["warns"].append({"chat_id": chat_id, "title": title, "count": n, "reason": reason, "warned_at": at, "warned_by": by})
+            elif kind == "mute":
+                d["mutes"].append({"chat_id": chat_id, "title": title, "until": n, "reason": reason, "muted_at": at, "muted_by": by,
+                                   "active": not n or n > now})
+            elif kind == "ban":
+                d["bans"].append({"chat_id": chat_id, "title": title, "until": n, "reason": reason, "banned_at": at, "banned_by": by,
+                                  "active": not n or n > now})
+            elif kind == "gban":
+                d["global_ban"] = {"user_id": user_id, "reason": reason, "banned_at": at, "banned_by": by}
+            elif kind == "msgs":
+                d["messages"][chat_id] = n or 0
+            else:
+                d["reg"][chat_id] = at
+        # Досчитываем ещё не сброшенное из буфера
+        for (u, c), n in self._pending_counts.items():
+            if u == user_id: d["messages"][c] = d["messages"].get(c, 0) + n
+        for (u, c), t in self._pending_regs.items():
+            if u == user_id: d["reg"].setdefault(c, t)
+        d["messages_total"] = sum(d["messages"].values())
+        return d
 
     # === КЭШ ===
     async def cache_action(self, key, data):
-        await self.db.execute("INSERT INTO action_cache (key,data) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET data=excluded.data, cached_at=strftime('%s','now')", (key, data))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO action_cache (key,data) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET data=excluded.data, cached_at=strftime('%s','now')", (key, data))
 
     async def get_cached_action(self, key):
         async with self.db.execute("SELECT data FROM action_cache WHERE key=?", (key,)) as cur:
@@ -351,36 +666,43 @@ class Database:
             return r[0] if r else None
 
     async def clear_cached_action(self, key):
-        await self.db.execute("DELETE FROM action_cache WHERE key=?", (key,))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM action_cache WHERE key=?", (key,))
 
     async def cleanup_old_cache(self, max_age=3600):
-        cutoff = int(time.time()) - max_age
-        await self.db.execute("DELETE FROM action_cache WHERE cached_at<?", (cutoff,))
-        await self.db.commit()
+        async with self._writing():
+            cutoff = int(time.time()) - max_age
+            await self.db.execute("DELETE FROM action_cache WHERE cached_at<?", (cutoff,))
 
     # === НИКИ ===
     async def set_nick(self, user_id, chat_id, nick):
-        await self.db.execute("INSERT INTO nicks (user_id,chat_id,nick) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET nick=excluded.nick", (user_id, chat_id, nick))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("INSERT INTO nicks (user_id,chat_id,nick) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET nick=excluded.nick", (user_id, chat_id, nick))
 
     async def get_nick(self, user_id, chat_id):
         async with self.db.execute("SELECT nick FROM nicks WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
             r = await cur.fetchone()
             return r[0] if r else None
 
+    async def get_nicks(self, user_ids, chat_id):
+        ids = list(user_ids)
+        if not ids: return {}
+        q = f"SELECT user_id, nick FROM nicks WHERE chat_id=? AND user_id IN ({','.join('?' * len(ids))})"
+        async with self.db.execute(q, (chat_id, *ids)) as cur:
+            return {r[0]: r[1] for r in await cur.fetchall() if r[1]}
+
     async def remove_nick(self, user_id, chat_id):
-        await self.db.execute("DELETE FROM nicks WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM nicks WHERE user_id=? AND chat_id=?", (user_id, chat_id))
 
     async def remove_nick_all(self, user_id):
-        await self.db.execute("DELETE FROM nicks WHERE user_id=?", (user_id,))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("DELETE FROM nicks WHERE user_id=?", (user_id,))
 
     async def set_nick_all(self, user_id, nick, chat_ids):
-        for cid in chat_ids:
-            await self.db.execute("INSERT INTO nicks (user_id,chat_id,nick) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET nick=excluded.nick", (user_id, cid, nick))
-        await self.db.commit()
+        async with self._writing():
+            for cid in chat_ids:
+                await self.db.execute("INSERT INTO nicks (user_id,chat_id,nick) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET nick=excluded.nick", (user_id, cid, nick))
 
     async def get_user_by_nick(self, nick, chat_id):
         async with self.db.execute("SELECT user_id FROM nicks WHERE nick=? COLLATE NOCASE AND chat_id=?", (nick, chat_id)) as cur:
@@ -397,102 +719,134 @@ class Database:
             return r[0] if r else None
 
     # === НАСТРОЙКИ ЧАТА ===
+    async def get_chat_settings(self, chat_id):
+        """Настройки чата из памяти; из БД читаются один раз до первого изменения."""
+        s = self._chat_settings.get(chat_id)
+        if s is None:
+            gen = self._chat_settings_gen
+            async with self.db.execute("SELECT ro_mode, quiet_mode, antiflood, filter, welcome_text FROM chats WHERE chat_id=?", (chat_id,)) as cur:
+                r = await cur.fetchone()
+            s = {
+                "ro_mode": bool(r["ro_mode"]) if r else False,
+                "quiet_mode": bool(r["quiet_mode"]) if r else False,
+                "antiflood": bool(r["antiflood"]) if r else False,
+                "filter": bool(r["filter"]) if r else False,
+                "welcome_text": (r["welcome_text"] or None) if r else None,
+            }
+            # Если пока читали, настройки поменяли — не кладём устаревшее
+            if gen == self._chat_settings_gen:
+                self._chat_settings[chat_id] = s
+        return s
+
+    async def _set_chat_setting(self, chat_id, column, value):
+        async with self._writing():
+            await self.db.execute(f"UPDATE chats SET {column}=? WHERE chat_id=?", (value, chat_id))
+        # Сбрасываем после коммита: иначе читатель успеет положить в кэш старые настройки
+        self._on_commit(lambda: self._forget_chat_settings(chat_id))
+
+    def _forget_chat_settings(self, chat_id):
+        self._chat_settings_gen += 1
+        self._chat_settings.pop(chat_id, None)
+
     async def get_welcome(self, chat_id):
-        async with self.db.execute("SELECT welcome_text FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-            r = await cur.fetchone()
-            return r[0] if r and r[0] else None
+        return (await self.get_chat_settings(chat_id))["welcome_text"]
 
     async def set_welcome(self, chat_id, text):
-        await self.db.execute("UPDATE chats SET welcome_text=? WHERE chat_id=?", (text, chat_id))
-        await self.db.commit()
+        await self._set_chat_setting(chat_id, "welcome_text", text)
 
     async def set_ro_mode(self, chat_id, enabled):
-        await self.db.execute("UPDATE chats SET ro_mode=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await self.db.commit()
+        await self._set_chat_setting(chat_id, "ro_mode", 1 if enabled else 0)
 
     async def is_ro_mode(self, chat_id):
-        try:
-            async with self.db.execute("SELECT ro_mode FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-                r = await cur.fetchone()
-                return bool(r[0]) if r else False
+        try: return (await self.get_chat_settings(chat_id))["ro_mode"]
         except: return False
 
     async def set_quiet_mode(self, chat_id, enabled):
-        await self.db.execute("UPDATE chats SET quiet_mode=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await self.db.commit()
+        await self._set_chat_setting(chat_id, "quiet_mode", 1 if enabled else 0)
 
     async def is_quiet_mode(self, chat_id):
-        try:
-            async with self.db.execute("SELECT quiet_mode FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-                r = await cur.fetchone()
-                return bool(r[0]) if r else False
+        try: return (await self.get_chat_settings(chat_id))["quiet_mode"]
         except: return False
 
     async def set_antiflood(self, chat_id, enabled):
-        await self.db.execute("UPDATE chats SET antiflood=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await self.db.commit()
+        await self._set_chat_setting(chat_id, "antiflood", 1 if enabled else 0)
 
     async def is_antiflood(self, chat_id):
-        async with self.db.execute("SELECT antiflood FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-            r = await cur.fetchone()
-            return bool(r[0]) if r else False
+        return (await self.get_chat_settings(chat_id))["antiflood"]
 
     async def set_filter(self, chat_id, enabled):
-        await self.db.execute("UPDATE chats SET filter=? WHERE chat_id=?", (1 if enabled else 0, chat_id))
-        await self.db.commit()
+        await self._set_chat_setting(chat_id, "filter", 1 if enabled else 0)
 
     async def is_filter(self, chat_id):
-        async with self.db.execute("SELECT filter FROM chats WHERE chat_id=?", (chat_id,)) as cur:
-            r = await cur.fetchone()
-            return bool(r[0]) if r else False
+        return (await self.get_chat_settings(chat_id))["filter"]
 
     # === BANWORDS ===
     async def get_banwords(self, chat_id):
         async with self.db.execute("SELECT word FROM banwords WHERE chat_id=?", (chat_id,)) as cur:
             return [r[0] for r in await cur.fetchall()]
 
+    async def get_banword_matcher(self, chat_id):
+        """Автомат по банвордам чата; пересобирается только после add/remove."""
+        m = self._banword_matchers.get(chat_id)
+        if m is None:
+            m = self._banword_matchers[chat_id] = WordMatcher(await self.get_banwords(chat_id))
+        return m
+
     async def add_banword(self, chat_id, word):
-        try:
-            await self.db.execute("INSERT INTO banwords (chat_id,word) VALUES (?,?)", (chat_id, word.lower()))
-            await self.db.commit()
-            return True
-        except: return False
+        async with self._writing():
+            try:
+                await self.db.execute("INSERT INTO banwords (chat_id,word) VALUES (?,?)", (chat_id, word.lower()))
+                self._banword_matchers.pop(chat_id, None)
+                return True
+            except: return False
 
     async def remove_banword(self, chat_id, word):
-        async with self.db.execute("SELECT 1 FROM banwords WHERE chat_id=? AND word=? COLLATE NOCASE", (chat_id, word)) as cur:
-            if not await cur.fetchone(): return False
-        await self.db.execute("DELETE FROM banwords WHERE chat_id=? AND word=? COLLATE NOCASE", (chat_id, word))
-        await self.db.commit()
-        return True
+        async with self._writing():
+            async with self.db.execute("SELECT 1 FROM banwords WHERE chat_id=? AND word=? COLLATE NOCASE", (chat_id, word)) as cur:
+                if not await cur.fetchone(): return False
+            await self.db.execute("DELETE FROM banwords WHERE chat_id=? AND word=? COLLATE NOCASE", (chat_id, word))
+            self._banword_matchers.pop(chat_id, None)
+            return True
 
     # === РЕГИСТРАЦИЯ ===
     async def register_user(self, user_id, chat_id):
-        await self.db.execute("INSERT OR IGNORE INTO user_reg (user_id,chat_id) VALUES (?,?)", (user_id, chat_id))
-        await self.db.commit()
+        """Первая встреча в чате; уже известные пары в базу не ходят."""
+        key = (user_id, chat_id)
+        if key in self._known_regs or key in self._pending_regs: return
+        self._pending_regs[key] = int(time.time())
+        if self._pending_rows() >= self.flush_rows:
+            await self.flush()
 
     async def get_user_reg(self, user_id, chat_id):
         async with self.db.execute("SELECT reg_at FROM user_reg WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
             r = await cur.fetchone()
-            return r[0] if r else None
+            return r[0] if r else self._pending_regs.get((user_id, chat_id))
 
     async def get_user_reg_all(self, user_id):
         async with self.db.execute("SELECT chat_id, reg_at FROM user_reg WHERE user_id=?", (user_id,)) as cur:
-            return [(r[0], r[1]) for r in await cur.fetchall()]
+            regs = [(r[0], r[1]) for r in await cur.fetchall()]
+        seen = {c for c, _ in regs}
+        return regs + [(c, t) for (u, c), t in self._pending_regs.items() if u == user_id and c not in seen]
 
     # === СООБЩЕНИЯ ===
     async def increment_message_count(self, user_id, chat_id):
-        await self.db.execute("INSERT INTO message_counts (user_id,chat_id,count) VALUES (?,?,1) ON CONFLICT(user_id,chat_id) DO UPDATE SET count=count+1", (user_id, chat_id))
-        await self.db.commit()
+        key = (user_id, chat_id)
+        self._pending_counts[key] = self._pending_counts.get(key, 0) + 1
+        if self._pending_rows() >= self.flush_rows:
+            await self.flush()
 
     async def get_message_count(self, user_id, chat_id=0):
+        # Досчитываем ещё не сброшенное из буфера
         if chat_id:
+            pending = self._pending_counts.get((user_id, chat_id), 0)
             async with self.db.execute("SELECT count FROM message_counts WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
                 r = await cur.fetchone()
-                return r[0] if r else 0
+                return (r[0] if r else 0) + pending
         else:
+            pending = sum(n for (u, _), n in self._pending_counts.items() if u == user_id)
             async with self.db.execute("SELECT SUM(count) FROM message_counts WHERE user_id=?", (user_id,)) as cur:
                 r = await cur.fetchone()
-                return r[0] if r else 0
+                return ((r[0] if r else 0) or 0) + pending
 
     async def get_top_messagers(self, chat_id, limit=10):
         async with self.db.execute("SELECT user_id, count FROM message_counts WHERE chat_id=? ORDER BY count DESC LIMIT ?", (chat_id, limit)) as cur:
@@ -500,10 +854,10 @@ class Database:
 
     # === РЕПОРТЫ ===
     async def create_report(self, reporter_id, chat_id, message_id, thread_id=0, reason=""):
-        await self.db.execute("INSERT INTO reports (reporter_id,chat_id,message_id,thread_id,reason) VALUES (?,?,?,?,?)", (reporter_id, chat_id, message_id, thread_id, reason))
-        await self.db.commit()
-        async with self.db.execute("SELECT last_insert_rowid()") as cur:
-            return (await cur.fetchone())[0]
+        async with self._writing():
+            await self.db.execute("INSERT INTO reports (reporter_id,chat_id,message_id,thread_id,reason) VALUES (?,?,?,?,?)", (reporter_id, chat_id, message_id, thread_id, reason))
+            async with self.db.execute("SELECT last_insert_rowid()") as cur:
+                return (await cur.fetchone())[0]
 
     async def get_report(self, report_id):
         async with self.db.execute("SELECT * FROM reports WHERE id=?", (report_id,)) as cur:
@@ -511,23 +865,9 @@ class Database:
             return dict(r) if r else None
 
     async def accept_report(self, report_id, accepted_by):
-        await self.db.execute("UPDATE reports SET status='accepted', accepted_by=? WHERE id=?", (accepted_by, report_id))
-        await self.db.commit()
+        async with self._writing():
+            await self.db.execute("UPDATE reports SET status='accepted', accepted_by=? WHERE id=?", (accepted_by, report_id))
 
     async def get_open_reports(self, limit=10):
         async with self.db.execute("SELECT * FROM reports WHERE status='open' ORDER BY created_at DESC LIMIT ?", (limit,)) as cur:
             return [dict(r) for r in await cur.fetchall()]
-
-    # === АНТИСПАМ ===
-    async def check_spam(self, user_id, chat_id, now, interval=2):
-        async with self.db.execute("SELECT ts FROM spam_track WHERE user_id=? AND chat_id=?", (user_id, chat_id)) as cur:
-            r = await cur.fetchone()
-        if r:
-            last_ts = r[0]
-            if now - last_ts < interval:
-                await self.db.execute("UPDATE spam_track SET ts=? WHERE user_id=? AND chat_id=?", (int(now), user_id, chat_id))
-                await self.db.commit()
-                return True
-        await self.db.execute("INSERT INTO spam_track (user_id,chat_id,ts) VALUES (?,?,?) ON CONFLICT(user_id,chat_id) DO UPDATE SET ts=excluded.ts", (user_id, chat_id, int(now)))
-        await self.db.commit()
-        return False
@@ -0,0 +1,98 @@
+"""
+Снятие истёкших временных наказаний (муты, баны).
+
+Сроки держатся в куче (heap) по времени истечения; фоновая задача спит до
+ближайшего срока и отдаёт все наступившие ключи пачкой в expire(keys).
+Перепланирование и отмена ленивые: в куче остаётся старая запись, но она
+пропускается, если срок ключа с тех пор изменился.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Expire = Callable[[List[Hashable]], Awaitable]
+
+
+class ExpiryScheduler:
+    def __init__(self, expire: Expire, batch: int = 500, retry: float = 30.0):
+        self.expire = expire
+        self.batch = batch
+        self.retry = retry
+        self.expired = 0
+        self._deadline: Dict[Hashable, float] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, key: Hashable, at: float):
+        """at — unix-время истечения; 0 и меньше — бессрочно (снимает план)."""
+        if at <= 0:
+            self.cancel(key)
+            return
+        self._deadline[key] = at
+        heapq.heappush(self._heap, (at, next(self._seq), key))
+        if len(self._heap) > 2 * len(self._deadline) + 1024:
+            self._heap = [(t, next(self._seq), k) for k, t in self._deadline.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][2] == key:
+            self._wake.set()
+
+    def cancel(self, key: Hashable):
+        self._deadline.pop(key, None)
+
+    def load(self, items: Iterable[Tuple[Hashable, float]]):
+        for key, at in items:
+            self.schedule(key, at)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+    def _due(self, now: float) -> List[Hashable]:
+        keys = []
+        while self._heap and self._heap[0][0] <= now and len(keys) < self.batch:
+            at, _, key = heapq.heappop(self._heap)
+            if self._deadline.get(key) == at:
+                del self._deadline[key]
+                keys.append(key)
+        return keys
+
+    async def _run(self):
+        while True:
+            # Выбрасываем устаревшие записи с вершины, чтобы не просыпаться зря
+            while self._heap and self._deadline.get(self._heap[0][2]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try: await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            keys = self._due(time.time())
+            if not keys:
+                continue
+            try:
+                await self.expire(keys)
+                self.expired += len(keys)
+            except Exception as e:
+                logger.warning(f"expiry: {e}")
+                for key in keys:
+                    if key not in self._deadline:
+                        self.schedule(key, time.time() + self.retry)
+
+    def stats(self) -> dict:
+        return {"scheduled": len(self._deadline), "heap": len(self._heap), "expired": self.expired}
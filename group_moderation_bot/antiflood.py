@@ -0,0 +1,85 @@
+"""Антифлуд в памяти — скользящее окно по (user_id, chat_id)."""
+
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+
+class _Entry:
+    __slots__ = ("ts", "strikes", "seen")
+
+    def __init__(self, seen: float):
+        self.ts: Optional[Deque[float]] = None
+        self.strikes = 0
+        self.seen = seen
+
+
+class FloodLimiter:
+    """Не больше `burst` сообщений за `window` секунд на пользователя в чате.
+
+    На ключ хранится кольцевой буфер из burst+1 последних отметок времени
+    и счётчик нарушений (strike). Ключи лежат в LRU-порядке: простаивающие
+    дольше `idle_ttl` и всё сверх `max_keys` вытесняются, так что память
+    ограничена и диск не трогается.
+    """
+
+    def __init__(self, burst: int = 1, window: float = 2.0,
+                 max_keys: int = 50_000, idle_ttl: float = 600.0):
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        self.idle_ttl = idle_ttl
+        self.evicted = 0
+        self._limits: Dict[int, Tuple[int, float]] = {}
+        self._entries: "OrderedDict[Tuple[int, int], _Entry]" = OrderedDict()
+
+    def set_chat_limits(self, chat_id: int, burst: int, window: float):
+        self._limits[chat_id] = (max(1, int(burst)), float(window))
+
+    def _touch(self, key: Tuple[int, int], now: float) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(now)
+        else:
+            entry.seen = now
+            self._entries.move_to_end(key)
+        self._evict(now)
+        return entry
+
+    def hit(self, user_id: int, chat_id: int, now: Optional[float] = None) -> bool:
+        """Учитывает сообщение; True — если лимит чата превышен."""
+        now = time.monotonic() if now is None else now
+        burst, window = self._limits.get(chat_id, (self.burst, self.window))
+        entry = self._touch((user_id, chat_id), now)
+        ts = entry.ts
+        if ts is None or ts.maxlen != burst + 1:
+            ts = entry.ts = deque(ts or (), maxlen=burst + 1)
+        ts.append(now)
+        return len(ts) > burst and now - ts[0] < window
+
+    def strike(self, user_id: int, chat_id: int = 0, now: Optional[float] = None) -> int:
+        """Увеличивает счётчик нарушений и возвращает новое значение."""
+        now = time.monotonic() if now is None else now
+        entry = self._touch((user_id, chat_id), now)
+        entry.strikes += 1
+        return entry.strikes
+
+    def reset_strikes(self, user_id: int, chat_id: int = 0):
+        entry = self._entries.get((user_id, chat_id))
+        if entry is not None:
+            entry.strikes = 0
+
+    def _evict(self, now: float):
+        entries = self._entries
+        while entries:
+            entry = next(iter(entries.values()))
+            if len(entries) <= self.max_keys and now - entry.seen < self.idle_ttl:
+                break
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {"keys": len(self._entries), "evicted": self.evicted}
+
+    def __len__(self):
+        return len(self._entries)
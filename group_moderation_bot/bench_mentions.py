@@ -0,0 +1,76 @@
+"""
+Замер mentions() против старого поштучного mention() для /staff.
+
+Запуск (сеть и config.json бота не используются):
+    python bench_mentions.py [staff] [latency_ms]
+
+bot.get_chat подменяется заглушкой с задержкой latency_ms, которая идёт
+через настоящий OutboundScheduler (его глобальный лимит 30 запросов/с).
+База — временный файл.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# main читает config.json из текущей папки — даём ему временный с фиктивным токеном
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp())
+with open("config.json", "w", encoding="utf-8") as f:
+    f.write('{"bot_token": "123456:bench"}')
+
+import main
+from db import Database
+from outbound import OutboundScheduler
+from userinfo import UserInfoCache
+
+
+class _Chat:
+    def __init__(self, uid):
+        self.username = f"u{uid}"
+        self.full_name = f"User {uid}"
+
+
+async def run(staff_count: int, latency: float):
+    async def get_chat(uid):
+        async def request():
+            await asyncio.sleep(latency)
+            return _Chat(uid)
+        return await main.scheduler.run(request, "GetChat", uid, lambda e: None)
+    main.bot.get_chat = get_chat
+
+    main.db = Database("bench.db")
+    await main.db.init()
+    try:
+        for uid in range(1000, 1000 + staff_count):
+            await main.db.set_global_role(uid, 1 + uid % 9)
+        ids = [uid for uid, _ in await main.db.get_all_staff()]
+
+        main.user_cache, main.scheduler = UserInfoCache(), OutboundScheduler()
+        t = time.perf_counter()
+        for uid in ids:
+            await main.mention(uid)
+        sequential = time.perf_counter() - t
+
+        main.user_cache, main.scheduler = UserInfoCache(), OutboundScheduler()
+        t = time.perf_counter()
+        await main.mentions(ids)
+        cold = time.perf_counter() - t
+        t = time.perf_counter()
+        await main.mentions(ids)
+        warm = time.perf_counter() - t
+    finally:
+        await main.db.close()
+
+    print(f"staff={len(ids)} latency={latency * 1000:.0f}ms")
+    print(f"  sequential (mention)  {sequential:.2f} s")
+    print(f"  batched, cold cache   {cold:.2f} s")
+    print(f"  batched, warm cache   {warm * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(run(count, latency_ms / 1000))
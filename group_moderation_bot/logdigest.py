@@ -0,0 +1,91 @@
+"""
+Очередь логов стафф-чата со склейкой событий.
+
+Одинаковые события (действие, цель, модератор, причина, срок) за окно
+`window` секунд сливаются в одно со списком чатов, а все события одного
+топика уходят одним сообщением. Отправка идёт в фоне, так что
+обработчики модерации на логировании не ждут.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# render(event, chat_ids, names) -> текст записи; names — общий на выгрузку
+# кэш имён, чтобы один пользователь не резолвился несколько раз
+Render = Callable[[dict, List[int], dict], Awaitable[str]]
+Send = Callable[[int, str], Awaitable]
+
+
+class LogDigest:
+    def __init__(self, render: Render, send: Send, window: float = 2.0,
+                 max_len: int = 4000):
+        self.render = render
+        self.send = send
+        self.window = window
+        self.max_len = max_len
+        self._pending: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def push(self, topic: int, event: dict, chat_id: int = 0):
+        """Поле "at" (время) в ключ склейки не входит — остаётся от первого события."""
+        key = (topic,) + tuple(sorted((k, v) for k, v in event.items() if k != "at"))
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = {"topic": topic, "event": event, "chats": []}
+        if chat_id not in entry["chats"]:
+            entry["chats"].append(chat_id)
+        self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.window)
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, OrderedDict()
+        names: dict = {}
+        by_topic: Dict[int, List[str]] = {}
+        for entry in batch.values():
+            try:
+                text = await self.render(entry["event"], entry["chats"], names)
+            except Exception as e:
+                logger.error(f"log digest render: {e}")
+                continue
+            by_topic.setdefault(entry["topic"], []).append(text)
+        for topic, parts in by_topic.items():
+            for text in self._pack(parts):
+                try: await self.send(topic, text)
+                except Exception as e: logger.error(f"log digest send: {e}")
+
+    def _pack(self, parts: List[str]) -> List[str]:
+        messages, cur = [], ""
+        for part in parts:
+            if cur and len(cur) + 2 + len(part) > self.max_len:
+                messages.append(cur)
+                cur = part
+            else:
+                cur = f"{cur}\n\n{part}" if cur else part
+        if cur:
+            messages.append(cur)
+        return messages
@@ -20,6 +20,11 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.enums import ChatType
 
 from db import Database
+from antiflood import FloodLimiter
+from outbound import OutboundScheduler
+from ratelimit import ApiThrottle, fan_out
+from logdigest import LogDigest
+from userinfo import UserInfoCache
 
 CONFIG_FILE = "config.json"
 config = {}
@@ -38,6 +43,15 @@ SUPPORT_LINK: str = config.get("support_link", "")
 PRESET_STAFF: dict = config.get("preset_staff", {})
 MAX_WARNS: int = config.get("max_warns", 3)
 SPAM_INTERVAL: int = config.get("spam_interval_seconds", 2)
+# {"chat_id": {"burst": сообщений, "interval": секунд}} — переопределение антифлуда по чатам
+ANTIFLOOD_LIMITS: dict = config.get("antiflood_limits", {})
+WRITE_BEHIND_INTERVAL_MS: int = config.get("write_behind_interval_ms", 1000)
+WRITE_BEHIND_MAX_ROWS: int = config.get("write_behind_max_rows", 500)
+LOG_DIGEST_WINDOW: float = config.get("log_digest_window", 2.0)
+USER_CACHE_TTL: int = config.get("user_cache_ttl", 3600)
+USER_CACHE_SIZE: int = config.get("user_cache_size", 50000)
+# Сообщать в чат, когда временный мут снят по сроку
+ANNOUNCE_UNMUTES: bool = config.get("announce_unmutes", False)
 ANON_ADMIN_ROLE: int = config.get("anon_admin_role", 10)
 PER_PAGE = 5
 ANONYMOUS_BOT_ID = 1087968824
@@ -46,11 +60,19 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=BOT_TOKEN)
+# Все запросы бота — через общий планировщик (лимиты, приоритеты, RetryAfter)
+scheduler = OutboundScheduler(log_chats=[STAFF_CHAT_ID] if STAFF_CHAT_ID else [])
+bot.session.middleware(ApiThrottle(scheduler))
+user_cache = UserInfoCache(ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 db: Database = None
 BOT_ID: int = 0
+# По умолчанию: второе сообщение быстрее SPAM_INTERVAL секунд — флуд
+flood = FloodLimiter(burst=1, window=SPAM_INTERVAL)
+for _cid, _lim in ANTIFLOOD_LIMITS.items():
+    flood.set_chat_limits(int(_cid), _lim.get("burst", 1), _lim.get("interval", SPAM_INTERVAL))
 
 ROLE_NAMES = {
     0: "Пользователь", 1: "Младший модератор", 2: "Модератор",
@@ -105,10 +127,7 @@ def extract_silent(args: list) -> tuple:
 
 async def get_role(user_id: int, chat_id: int = 0) -> int:
     if user_id == 0 or user_id == ANONYMOUS_BOT_ID: return 0
-    g = await db.get_global_role(user_id)
-    if g > 0: return g
-    if chat_id: return await db.get_user_role(user_id, chat_id)
-    return 0
+    return await db.get_role(user_id, chat_id)
 
 async def caller_role(message: Message) -> int:
     if is_anon(message): return ANON_ADMIN_ROLE
@@ -139,14 +158,17 @@ async def check_role(message: Message, cmd: str) -> int:
     await message.reply(f"❌ Недостаточно прав (нужна роль {needed}+)")
     return -1
 
+async def _fetch_user_info(user_id: int) -> dict:
+    chat = await bot.get_chat(user_id)
+    uname = chat.username or ""
+    if uname: await db.cache_username(user_id, uname)
+    return {"id": user_id, "username": uname, "full_name": chat.full_name or f"User {user_id}"}
+
 async def get_user_info(user_id: int) -> dict:
     if user_id == 0 or user_id == ANONYMOUS_BOT_ID:
         return {"id": user_id, "username": "", "full_name": "Анонимный администратор"}
     try:
-        chat = await bot.get_chat(user_id)
-        uname = chat.username or ""
-        if uname: await db.cache_username(user_id, uname)
-        return {"id": user_id, "username": uname, "full_name": chat.full_name or f"User {user_id}"}
+        return await user_cache.get(user_id, _fetch_user_info)
     except Exception:
         cached = await db.get_username_by_id(user_id)
         return {"id": user_id, "username": cached or "", "full_name": f"@{cached}" if cached else f"ID:{user_id}"}
@@ -161,6 +183,16 @@ async def mention(user_id: int, chat_id: int = 0) -> str:
     info = await get_user_info(user_id)
     return f'<a href="tg://user?id={user_id}">{info["full_name"]}</a>'
 
+async def mentions(user_ids, chat_id: int = 0, limit: int = 10) -> dict:
+    """mention() для списка: ники одним запросом, остальные имена — параллельно."""
+    ids = list(dict.fromkeys(user_ids))
+    nicks = await db.get_nicks(ids, chat_id) if chat_id else {}
+    sem = asyncio.Semaphore(limit)
+    async def one(uid):
+        if uid in nicks: return f'<a href="tg://user?id={uid}">{nicks[uid]}</a>'
+        async with sem: return await mention(uid)
+    return dict(zip(ids, await asyncio.gather(*(one(u) for u in ids))))
+
 async def resolve_username(username: str) -> Optional[int]:
     username = username.lower().lstrip("@")
     cached = await db.get_user_by_username(username)
@@ -246,9 +278,8 @@ def full_perms():
 
 async def build_chat_selector(action_key):
     b = InlineKeyboardBuilder()
-    for cid in await db.get_all_chat_ids():
+    for cid, title in (await db.get_chat_titles()).items():
         if cid == STAFF_CHAT_ID: continue
-        title = await db.get_chat_title(cid)
         short = title[:25] + "…" if len(title) > 25 else title
         b.button(text=f"💬 {short}", callback_data=f"cs:{action_key}:{cid}")
     b.button(text="🌐 Все чаты", callback_data=f"cs:{action_key}:all")
@@ -256,36 +287,49 @@ async def build_chat_selector(action_key):
     b.adjust(1)
     return b
 
+async def _user_cached(user_id, names):
+    if user_id not in names: names[user_id] = await get_user_info(user_id)
+    return names[user_id]
+
+async def _chats_label(chat_ids):
+    if chat_ids == [0]: return "все чаты"
+    titles = [await db.get_chat_title(c) if c else "все чаты" for c in chat_ids[:10]]
+    if len(chat_ids) > 10: titles.append(f"и ещё {len(chat_ids) - 10}")
+    return ", ".join(titles)
+
+async def _render_log(ev, chat_ids, names):
+    target, duration, reason = ev["target"], ev["duration"], ev["reason"]
+    ti = await _user_cached(target, names)
+    tu = f" (@{ti['username']})" if ti["username"] else ""
+    ct = await _chats_label(chat_ids)
+    if ev["kind"] == "punish":
+        text = f"📋 <b>{ev['action']}</b>\n👤 {ti['full_name']}{tu} (<code>{target}</code>)\n"
+        if duration >= 0: text += f"⏱ {fmt_dur(duration)}\n"
+        if reason: text += f"📝 {reason}\n"
+        return text + f"💬 {ct} | 🕐 {ev['at']}"
+    ci = await _user_cached(ev["caller"], names)
+    cu = f" (@{ci['username']})" if ci["username"] else ""
+    text = f"📋 <b>{ev['action']}</b>\n━━━━━━━━━━━━━━━━\n👤 Кому: {ti['full_name']}{tu}\n🆔 <code>{target}</code>\n"
+    if duration >= 0:
+        text += f"⏱ {fmt_dur(duration)}\n📅 До: {end_date_str(duration)}\n"
+    if reason: text += f"📝 {reason}\n"
+    return text + f"👮 {ci['full_name']}{cu}\n💬 {ct}\n🕐 {ev['at']}"
+
+async def _send_log(topic, text):
+    await bot.send_message(STAFF_CHAT_ID, text, parse_mode="HTML", message_thread_id=topic)
+
+# Логи стафф-чата: копятся LOG_DIGEST_WINDOW секунд и уходят сводкой в фоне
+staff_log = LogDigest(_render_log, _send_log, window=LOG_DIGEST_WINDOW)
+
 async def log_action(action, target, caller_id_val, reason="", duration=-1, chat_id=0):
     if not STAFF_CHAT_ID or not LOG_TOPIC_ID: return
-    try:
-        ti = await get_user_info(target)
-        ci = await get_user_info(caller_id_val)
-        ct = await db.get_chat_title(chat_id) if chat_id else "все чаты"
-        tu = f" (@{ti['username']})" if ti["username"] else ""
-        cu = f" (@{ci['username']})" if ci["username"] else ""
-        text = f"📋 <b>{action}</b>\n━━━━━━━━━━━━━━━━\n👤 Кому: {ti['full_name']}{tu}\n🆔 <code>{target}</code>\n"
-        if duration >= 0:
-            text += f"⏱ {fmt_dur(duration)}\n📅 До: {end_date_str(duration)}\n"
-        if reason: text += f"📝 {reason}\n"
-        text += f"👮 {ci['full_name']}{cu}\n💬 {ct}\n🕐 {now_str()}"
-        await bot.send_message(STAFF_CHAT_ID, text, parse_mode="HTML", message_thread_id=LOG_TOPIC_ID)
-    except Exception as e:
-        logger.error(f"log_action: {e}")
+    staff_log.push(LOG_TOPIC_ID, {"kind": "action", "action": action, "target": target, "caller": caller_id_val,
+                                  "reason": reason, "duration": duration, "at": now_str()}, chat_id)
 
 async def log_punish(action, target, caller_id_val, reason="", duration=-1, chat_id=0):
     if not STAFF_CHAT_ID or not PUNISH_TOPIC_ID: return
-    try:
-        ti = await get_user_info(target)
-        ct = await db.get_chat_title(chat_id) if chat_id else "все чаты"
-        tu = f" (@{ti['username']})" if ti["username"] else ""
-        text = f"📋 <b>{action}</b>\n👤 {ti['full_name']}{tu} (<code>{target}</code>)\n"
-        if duration >= 0: text += f"⏱ {fmt_dur(duration)}\n"
-        if reason: text += f"📝 {reason}\n"
-        text += f"💬 {ct} | 🕐 {now_str()}"
-        await bot.send_message(STAFF_CHAT_ID, text, parse_mode="HTML", message_thread_id=PUNISH_TOPIC_ID)
-    except Exception as e:
-        logger.error(f"log_punish: {e}")
+    staff_log.push(PUNISH_TOPIC_ID, {"kind": "punish", "action": action, "target": target, "caller": caller_id_val,
+                                     "reason": reason, "duration": duration, "at": now_str()}, chat_id)
 
 async def notify_dm(user_id, action_name, reason, duration, cid):
     try:
@@ -295,17 +339,31 @@ async def notify_dm(user_id, action_name, reason, duration, cid):
         await bot.send_message(user_id, text, parse_mode="HTML")
     except Exception: pass
 
-async def apply_warn(target, chat_ids, cid, reason, silent=False):
+async def _log_each(action, target, cid, reason, duration, chat_ids, silent):
     for c in chat_ids:
-        warns = await db.add_warn(target, c, cid, reason)
+        await log_action(action, target, cid, reason, duration, c)
+        if not silent: await log_punish(action, target, cid, reason, duration, c)
+
+def _log_failures(action, target, results):
+    for c, e in results.items():
+        if e is not None: logger.error(f"{action} {target} in {c}: {e}")
+    return sum(e is None for e in results.values())
+
+async def apply_warn(target, chat_ids, cid, reason, silent=False):
+    # Счётчики и сброс на пороге — одной транзакцией на все чаты, API уже после
+    async with db.transaction():
+        counts = {}
+        for c in chat_ids:
+            counts[c] = await db.add_warn(target, c, cid, reason)
+            if counts[c] >= MAX_WARNS: await db.clear_warns(target, c)
+    async def one(c):
+        warns = counts[c]
         name = await mention(target, c)
         if warns >= MAX_WARNS:
             try:
                 await bot.ban_chat_member(c, target)
-                await asyncio.sleep(0.5)
                 await bot.unban_chat_member(c, target)
             except Exception: pass
-            await db.clear_warns(target, c)
             if not silent:
                 try: await bot.send_message(c, f"⚠️ {name} — ({MAX_WARNS}/{MAX_WARNS})\n{reason}\n\n👢 Кик!", parse_mode="HTML")
                 except Exception: pass
@@ -313,70 +371,59 @@ async def apply_warn(target, chat_ids, cid, reason, silent=False):
             if not silent:
                 try: await bot.send_message(c, f"⚠️ {name} — ({warns}/{MAX_WARNS})\n{reason}", parse_mode="HTML")
                 except Exception: pass
-        await log_action("ВАРН", target, cid, reason, chat_id=c)
-        if not silent: await log_punish("ВАРН", target, cid, reason, chat_id=c)
+    _log_failures("warn", target, await fan_out(chat_ids, one))
+    await _log_each("ВАРН", target, cid, reason, -1, chat_ids, silent)
     await notify_dm(target, "Предупреждение", reason, -1, cid)
 
 async def apply_mute(target, chat_ids, cid, reason, seconds, silent=False):
-    for c in chat_ids:
-        try:
-            until = int(time.time()) + seconds if seconds > 0 else 0
-            delta = timedelta(seconds=seconds) if seconds > 0 else None
-            await bot.restrict_chat_member(c, target, permissions=muted_perms(), until_date=delta)
-            await db.add_mute(target, c, cid, reason, until)
-            if not silent:
-                name = await mention(target, c)
-                await bot.send_message(c, f"🔇 {name} замучен на {fmt_dur(seconds)}\n{reason}", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"mute {target} in {c}: {e}")
-        await log_action("МУТ", target, cid, reason, seconds, c)
-        if not silent: await log_punish("МУТ", target, cid, reason, seconds, c)
+    until = int(time.time()) + seconds if seconds > 0 else 0
+    delta = timedelta(seconds=seconds) if seconds > 0 else None
+    async def one(c):
+        await bot.restrict_chat_member(c, target, permissions=muted_perms(), until_date=delta)
+        await db.add_mute(target, c, cid, reason, until)
+        if not silent:
+            name = await mention(target, c)
+            await bot.send_message(c, f"🔇 {name} замучен на {fmt_dur(seconds)}\n{reason}", parse_mode="HTML")
+    _log_failures("mute", target, await fan_out(chat_ids, one))
+    await _log_each("МУТ", target, cid, reason, seconds, chat_ids, silent)
     await notify_dm(target, "Вы замучены", reason, seconds, cid)
 
 async def apply_ban(target, chat_ids, cid, reason, seconds, silent=False):
-    for c in chat_ids:
-        try:
-            delta = timedelta(seconds=seconds) if seconds > 0 else None
-            until = int(time.time()) + seconds if seconds > 0 else 0
-            await bot.ban_chat_member(c, target, until_date=delta)
-            await db.add_ban(target, c, cid, reason, until)
-            if not silent:
-                name = await mention(target, c)
-                await bot.send_message(c, f"🚫 {name} забанен на {fmt_dur(seconds)}\n{reason}", parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"ban {target} in {c}: {e}")
-        await log_action("БАН", target, cid, reason, seconds, c)
-        if not silent: await log_punish("БАН", target, cid, reason, seconds, c)
+    until = int(time.time()) + seconds if seconds > 0 else 0
+    delta = timedelta(seconds=seconds) if seconds > 0 else None
+    async def one(c):
+        await bot.ban_chat_member(c, target, until_date=delta)
+        await db.add_ban(target, c, cid, reason, until)
+        if not silent:
+            name = await mention(target, c)
+            await bot.send_message(c, f"🚫 {name} забанен на {fmt_dur(seconds)}\n{reason}", parse_mode="HTML")
+    _log_failures("ban", target, await fan_out(chat_ids, one))
+    await _log_each("БАН", target, cid, reason, seconds, chat_ids, silent)
     await notify_dm(target, "Вы заблокированы", reason, seconds, cid)
 
 async def apply_kick(target, chat_ids, cid, reason, silent=False):
-    for c in chat_ids:
-        try:
-            await bot.ban_chat_member(c, target)
-            await asyncio.sleep(0.5)
-            await bot.unban_chat_member(c, target)
-            if not silent:
-                name = await mention(target, c)
-                await bot.send_message(c, f"👢 {name} кикнут\n{reason}", parse_mode="HTML")
-        except Exception: pass
-        await log_action("КИК", target, cid, reason, chat_id=c)
-        if not silent: await log_punish("КИК", target, cid, reason, chat_id=c)
+    async def one(c):
+        await bot.ban_chat_member(c, target)
+        await bot.unban_chat_member(c, target)
+        if not silent:
+            name = await mention(target, c)
+            await bot.send_message(c, f"👢 {name} кикнут\n{reason}", parse_mode="HTML")
+    await fan_out(chat_ids, one)
+    await _log_each("КИК", target, cid, reason, -1, chat_ids, silent)
     await notify_dm(target, "Вы кикнуты", reason, -1, cid)
 
 async def apply_unmute(target, chat_ids, cid):
-    for c in chat_ids:
-        try:
-            await bot.restrict_chat_member(c, target, permissions=full_perms())
-            await db.remove_mute(target, c)
-        except Exception: pass
+    async def one(c):
+        await bot.restrict_chat_member(c, target, permissions=full_perms())
+        await db.remove_mute(target, c)
+    await fan_out(chat_ids, one)
     await log_action("РАЗМУТ", target, cid)
 
 async def apply_unban(target, chat_ids, cid):
-    for c in chat_ids:
-        try:
-            await bot.unban_chat_member(c, target, only_if_banned=True)
-            await db.remove_ban(target, c)
-        except Exception: pass
+    async def one(c):
+        await bot.unban_chat_member(c, target, only_if_banned=True)
+        await db.remove_ban(target, c)
+    await fan_out(chat_ids, one)
     await log_action("РАЗБАН", target, cid)
 
 async def apply_unwarn(target, chat_ids, cid):
@@ -394,7 +441,7 @@ async def cmd_start(message: Message):
     if message.chat.type != ChatType.PRIVATE: return
     if not message.from_user: return
     uid = message.from_user.id
-    p = await db.get_user_all_punishments(uid)
+    p = await db.get_user_dossier(uid)
     text = "👋 <b>Привет!</b>\nБот модерации.\n\n"
     found = False
     if p["global_ban"]:
@@ -402,20 +449,18 @@ async def cmd_start(message: Message):
         text += f"🌐 <b>Глоб. бан</b>\n  Дата: {fmt_ts(gb.get('banned_at',0))}\n  Причина: {gb.get('reason','—')}\n\n"
         found = True
     for ban in p["bans"]:
-        ct = await db.get_chat_title(ban["chat_id"])
         until = ban.get("until", 0)
         end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
-        text += f"🚫 <b>Бан</b> — {ct}\n  До: {end}\n  Причина: {ban.get('reason','—')}\n\n"
+        text += f"🚫 <b>Бан</b> — {ban['title']}\n  До: {end}\n  Причина: {ban.get('reason','—')}\n\n"
         found = True
     for mute in p["mutes"]:
-        ct = await db.get_chat_title(mute["chat_id"])
+        if not mute["active"]: continue
         until = mute.get("until", 0)
-        end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
-        text += f"🔇 <b>Мут</b> — {ct}\n  До: {end}\n  Причина: {mute.get('reason','—')}\n\n"
+        end = fmt_ts(until) if until else "навсегда"
+        text += f"🔇 <b>Мут</b> — {mute['title']}\n  До: {end}\n  Причина: {mute.get('reason','—')}\n\n"
         found = True
     for w in p["warns"]:
-        ct = await db.get_chat_title(w["chat_id"])
-        text += f"⚠️ <b>Варны: {w['count']}/{MAX_WARNS}</b> — {ct}\n\n"
+        text += f"⚠️ <b>Варны: {w['count']}/{MAX_WARNS}</b> — {w['title']}\n\n"
         found = True
     if not found: text += "✅ Наказаний нет!\n"
     if SUPPORT_LINK: text += f"\n📞 {SUPPORT_LINK}"
@@ -500,16 +545,17 @@ async def cmd_stats(message: Message):
     info = await get_user_info(target)
     cid = message.chat.id if not in_staff(message) else 0
     role = await get_role(target, cid) if cid else await get_role(target)
-    mc_chat = await db.get_message_count(target, cid) if cid else 0
-    mc_total = await db.get_message_count(target)
+    d = await db.get_user_dossier(target)
+    mc_chat = d["messages"].get(cid, 0) if cid else 0
+    mc_total = d["messages_total"]
     t = f"📊 <b>Статистика</b>\n\nID: <code>{target}</code>\n"
     if info["username"]: t += f"@{info['username']}\n"
     t += f"Роль: {ROLE_NAMES.get(role,'?')} ({role})\n"
     if cid:
         t += f"📨 В чате: {mc_chat}\n"
-        warns = await db.get_warns(target, cid)
-        is_m = await db.is_muted(target, cid)
-        is_b = await db.is_banned(target, cid)
+        warns = next((w["count"] for w in d["warns"] if w["chat_id"] == cid), 0)
+        is_m = any(m["active"] for m in d["mutes"] if m["chat_id"] == cid)
+        is_b = any(b["active"] for b in d["bans"] if b["chat_id"] == cid)
         t += f"Варны: {warns}/{MAX_WARNS}\nМут: {'да' if is_m else 'нет'}\nБан: {'да' if is_b else 'нет'}\n"
     t += f"📨 Всего: {mc_total}"
     await message.answer(t, parse_mode="HTML")
@@ -521,11 +567,12 @@ async def cmd_staff(message: Message):
     by_role = {}
     for uid, r in staff:
         by_role.setdefault(r, []).append(uid)
+    names = await mentions(uid for uid, _ in staff)
     text = "👥 <b>Команда</b>\n\n"
     for r in sorted(by_role.keys(), reverse=True):
         text += f"<b>{ROLE_NAMES.get(r,'?')} ({r}):</b>\n"
         for uid in by_role[r]:
-            text += f"  • {await mention(uid)}\n"
+            text += f"  • {names[uid]}\n"
         text += "\n"
     await message.answer(text, parse_mode="HTML")
 
@@ -535,19 +582,19 @@ async def cmd_top(message: Message):
     cid = message.chat.id
     top = await db.get_top_messagers(cid, 10)
     if not top: return await message.reply("ℹ️ Нет данных")
+    names = await mentions((uid for uid, _ in top), cid)
     text = "🏆 <b>Топ по сообщениям</b>\n\n"
     for i, (uid, count) in enumerate(top, 1):
-        name = await mention(uid, cid)
+        name = names[uid]
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
         text += f"{medal} {name} — {count}\n"
     await message.answer(text, parse_mode="HTML")
 
 @router.message(Command("pullinfo"))
 async def cmd_pullinfo(message: Message):
-    chat_ids = await db.get_all_chat_ids()
-    text = f"🌐 <b>Сетка</b>\n📊 Чатов: <b>{len(chat_ids)}</b>\n\n"
-    for cid in chat_ids:
-        title = await db.get_chat_title(cid)
+    titles = await db.get_chat_titles()
+    text = f"🌐 <b>Сетка</b>\n📊 Чатов: <b>{len(titles)}</b>\n\n"
+    for cid, title in titles.items():
         m = "📌" if cid == STAFF_CHAT_ID else "💬"
         text += f"{m} {title}\n   <code>{cid}</code>\n"
     await message.reply(text, parse_mode="HTML")
@@ -769,20 +816,15 @@ async def cmd_getwarn(message: Message):
     info = await get_user_info(target)
     text = f"🔍 <b>Варны/муты</b>\n👤 {info['full_name']} (<code>{target}</code>)\n\n"
     found = False
-    for c in await db.get_all_chat_ids():
-        wi = await db.get_warn_info(target, c)
-        if wi and wi["count"] > 0:
-            ct = await db.get_chat_title(c)
-            text += f"⚠️ {wi['count']}/{MAX_WARNS} — {ct}\n"
-            found = True
-    for c in await db.get_all_chat_ids():
-        mi = await db.get_mute_info(target, c)
-        if mi:
-            ct = await db.get_chat_title(c)
-            until = mi.get("until", 0)
-            end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
-            text += f"🔇 Мут — {ct} до {end}\n"
-            found = True
+    d = await db.get_user_dossier(target)
+    for wi in d["warns"]:
+        text += f"⚠️ {wi['count']}/{MAX_WARNS} — {wi['title']}\n"
+        found = True
+    for mi in d["mutes"]:
+        until = mi.get("until", 0)
+        end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
+        text += f"🔇 Мут — {mi['title']} до {end}\n"
+        found = True
     if not found: text += "✅ Чисто"
     await message.answer(text, parse_mode="HTML")
 
@@ -800,8 +842,8 @@ async def cmd_warnlist(message: Message):
     tp = max(1, math.ceil(total / PER_PAGE))
     if not rows: return await message.answer("⚠️ <b>Варны</b>\n\nПусто.", parse_mode="HTML")
     text = f"⚠️ <b>Варны</b> — стр. {page+1}/{tp}\n\n"
-    for i, row in enumerate(rows, start=page*PER_PAGE+1):
-        info = await get_user_info(row["user_id"])
+    infos = await asyncio.gather(*(get_user_info(row["user_id"]) for row in rows))
+    for i, (row, info) in enumerate(zip(rows, infos), start=page*PER_PAGE+1):
         text += f"<b>{i}.</b> {info['full_name']} — <code>{row['user_id']}</code>\n    {row['count']}/{MAX_WARNS} | {row.get('reason','—')}\n\n"
     text += f"Всего: {total}"
     if tp > 1: text += f"\n/warnlist {page+2}"
@@ -853,8 +895,8 @@ async def cmd_banlist(message: Message):
     tp = max(1, math.ceil(total / PER_PAGE))
     if not rows: return await message.answer(f"{title}\nПусто. /banlist global", parse_mode="HTML")
     text = f"{title} — стр. {page+1}/{tp}\n\n"
-    for i, row in enumerate(rows, start=page*PER_PAGE+1):
-        info = await get_user_info(row["user_id"])
+    infos = await asyncio.gather(*(get_user_info(row["user_id"]) for row in rows))
+    for i, (row, info) in enumerate(zip(rows, infos), start=page*PER_PAGE+1):
         until = row.get("until", 0)
         end = fmt_ts(until) if until and until > int(time.time()) else ("истёк" if until else "навсегда")
         text += f"<b>{i}.</b> {info['full_name']} — <code>{row['user_id']}</code>\n    {row.get('reason','—')} | {end}\n\n"
@@ -957,24 +999,23 @@ async def cmd_nlist(message: Message):
     # Показываем ники текущего чата, или всех если стафф
     if in_staff(message):
         text = "📝 <b>Ники (все чаты)</b>\n\n"
-        found = False
-        for c in await db.get_all_chat_ids():
-            if c == STAFF_CHAT_ID: continue
-            nicks = await db.get_all_nicks(c)
-            if nicks:
-                ct = await db.get_chat_title(c)
-                text += f"<b>{ct}:</b>\n"
-                for uid, nick in nicks:
-                    text += f"  • <b>{nick}</b> — {await mention(uid)}\n"
-                text += "\n"
-                found = True
-        if not found: return await message.reply("ℹ️ Пусто")
+        titles = await db.get_chat_titles()
+        by_chat = {c: await db.get_all_nicks(c) for c in titles if c != STAFF_CHAT_ID}
+        by_chat = {c: n for c, n in by_chat.items() if n}
+        if not by_chat: return await message.reply("ℹ️ Пусто")
+        names = await mentions(uid for nicks in by_chat.values() for uid, _ in nicks)
+        for c, nicks in by_chat.items():
+            text += f"<b>{titles[c]}:</b>\n"
+            for uid, nick in nicks:
+                text += f"  • <b>{nick}</b> — {names[uid]}\n"
+            text += "\n"
     else:
         nicks = await db.get_all_nicks(message.chat.id)
         if not nicks: return await message.reply("ℹ️ Пусто")
+        names = await mentions(uid for uid, _ in nicks)
         text = "📝 <b>Ники</b>\n\n"
         for uid, nick in nicks:
-            text += f"• <b>{nick}</b> — {await mention(uid)} (<code>{uid}</code>)\n"
+            text += f"• <b>{nick}</b> — {names[uid]} (<code>{uid}</code>)\n"
     await message.answer(text, parse_mode="HTML")
 
 @router.message(Command("online"))
@@ -1064,18 +1105,16 @@ async def cmd_getban(message: Message):
     info = await get_user_info(target)
     text = f"🔍 <b>Баны</b>\n👤 {info['full_name']} (<code>{target}</code>)\n\n"
     found = False
-    gb = await db.get_global_ban_info(target)
+    d = await db.get_user_dossier(target)
+    gb = d["global_ban"]
     if gb:
         text += f"🌐 <b>Глоб. бан</b>\n  {fmt_ts(gb.get('banned_at',0))} | {gb.get('reason','—')}\n\n"
         found = True
-    for c in await db.get_all_chat_ids():
-        ban = await db.get_ban_info(target, c)
-        if ban:
-            ct = await db.get_chat_title(c)
-            until = ban.get("until",0)
-            end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
-            text += f"🚫 {ct} — до {end}\n  {ban.get('reason','—')}\n\n"
-            found = True
+    for ban in d["bans"]:
+        until = ban.get("until",0)
+        end = fmt_ts(until) if until and until > int(time.time()) else ("навсегда" if not until else "истёк")
+        text += f"🚫 {ban['title']} — до {end}\n  {ban.get('reason','—')}\n\n"
+        found = True
     if not found: text += "✅ Банов нет"
     await message.answer(text, parse_mode="HTML")
 
@@ -1169,14 +1208,9 @@ async def cmd_clear(message: Message):
         count = int(args[1])
         if not (1 <= count <= 100): return await message.reply("❌ 1-100")
     except ValueError: return await message.reply("❌ 1-100")
-    deleted = 0
     mid = message.message_id
-    for i in range(1, count + 1):
-        try:
-            await bot.delete_message(message.chat.id, mid - i)
-            deleted += 1
-        except Exception: pass
-        if i % 5 == 0: await asyncio.sleep(0.3)
+    results = await asyncio.gather(*(bot.delete_message(message.chat.id, mid - i) for i in range(1, count + 1)), return_exceptions=True)
+    deleted = sum(r is True for r in results)
     try:
         st = await message.answer(f"🧹 {deleted}/{count}")
         await asyncio.sleep(3)
@@ -1203,14 +1237,12 @@ async def cmd_gban(message: Message):
     reason = args[2] if len(args) > 2 else "Глобальный бан"
     cid = await caller_id(message)
     await db.add_global_ban(target, cid, reason)
-    ok, fail = 0, 0
-    for c in await db.get_all_chat_ids():
-        try:
-            await bot.ban_chat_member(c, target)
-            await db.add_ban(target, c, cid, "Глобальный бан")
-            ok += 1
-        except Exception: fail += 1
-        await asyncio.sleep(0.1)
+    async def one(c):
+        await bot.ban_chat_member(c, target)
+        await db.add_ban(target, c, cid, "Глобальный бан")
+    results = await fan_out(await db.get_all_chat_ids(), one)
+    ok = _log_failures("gban", target, results)
+    fail = len(results) - ok
     name = await mention(target)
     result = f"🌐 Глобальный бан!\n{name} — <code>{target}</code>\n{reason}\n✅ {ok} чатов"
     if fail: result += f" | ⚠️ {fail} неудач"
@@ -1233,14 +1265,10 @@ async def cmd_ungban(message: Message):
     if not target: return await message.reply("❌ /ungban @user")
     if not await db.is_globally_banned(target): return await message.reply("ℹ️ Нет глоб. бана")
     await db.remove_global_ban(target)
-    ok = 0
-    for c in await db.get_all_chat_ids():
-        try:
-            await bot.unban_chat_member(c, target, only_if_banned=True)
-            await db.remove_ban(target, c)
-            ok += 1
-        except Exception: pass
-        await asyncio.sleep(0.1)
+    async def one(c):
+        await bot.unban_chat_member(c, target, only_if_banned=True)
+        await db.remove_ban(target, c)
+    ok = _log_failures("ungban", target, await fan_out(await db.get_all_chat_ids(), one))
     name = await mention(target)
     await message.reply(f"✅ Глоб. бан снят! {name}\n{ok} чатов", parse_mode="HTML")
     await log_action("СНЯТИЕ ГЛОБ. БАНА", target, await caller_id(message))
@@ -1386,6 +1414,22 @@ async def cb_cancel(call: CallbackQuery):
 # СОБЫТИЯ
 # =============================================================================
 
+async def feed_user_cache(handler, event, data):
+    """Outer-middleware: имена из апдейта сразу попадают в user_cache."""
+    users = []
+    if isinstance(event, Message):
+        users = [event.from_user, event.reply_to_message.from_user if event.reply_to_message else None]
+        users += event.new_chat_members or []
+    elif isinstance(event, ChatMemberUpdated):
+        users = [event.from_user, event.new_chat_member.user]
+    for u in users:
+        if u and not u.is_bot and u.id != ANONYMOUS_BOT_ID:
+            user_cache.put(u.id, u.full_name, u.username)
+    return await handler(event, data)
+
+dp.message.outer_middleware(feed_user_cache)
+dp.chat_member.outer_middleware(feed_user_cache)
+
 @router.chat_member(ChatMemberUpdatedFilter(IS_NOT_MEMBER >> IS_MEMBER))
 async def on_user_join(event: ChatMemberUpdated):
     uid = event.new_chat_member.user.id
@@ -1452,19 +1496,16 @@ async def on_message(message: Message):
         except Exception: pass
         return
 
-    if role < 1 and await db.is_quiet_mode(cid):
-        try: await message.delete()
-        except Exception: pass
-        return
+    if role >= 1: return
+    settings = await db.get_chat_settings(cid)
 
-    if role < 1 and await db.is_ro_mode(cid):
+    if settings["quiet_mode"] or settings["ro_mode"]:
         try: await message.delete()
         except Exception: pass
         return
 
-    if role < 1 and await db.is_antiflood(cid):
-        is_spam = await db.check_spam(uid, cid, time.time(), SPAM_INTERVAL)
-        if is_spam:
+    if settings["antiflood"]:
+        if flood.hit(uid, cid):
             try:
                 until = int(time.time()) + 1800
                 await db.add_mute(uid, cid, 0, "Антиспам", until)
@@ -1475,19 +1516,17 @@ async def on_message(message: Message):
             except Exception: pass
             return
 
-    if role < 1 and message.text and await db.is_filter(cid):
-        words = await db.get_banwords(cid)
-        low = message.text.lower()
-        for w in words:
-            if w in low:
-                try:
-                    await message.delete()
-                    until = int(time.time()) + 1800
-                    await db.add_mute(uid, cid, 0, "Запрещённое слово", until)
-                    await bot.restrict_chat_member(cid, uid, permissions=muted_perms(), until_date=timedelta(minutes=30))
-                    await bot.send_message(cid, f"🔇 {await mention(uid)} (запрещённое слово)", parse_mode="HTML")
-                except Exception: pass
-                return
+    if message.text and settings["filter"]:
+        matcher = await db.get_banword_matcher(cid)
+        if matcher.find(message.text.lower()):
+            try:
+                await message.delete()
+                until = int(time.time()) + 1800
+                await db.add_mute(uid, cid, 0, "Запрещённое слово", until)
+                await bot.restrict_chat_member(cid, uid, permissions=muted_perms(), until_date=timedelta(minutes=30))
+                await bot.send_message(cid, f"🔇 {await mention(uid)} (запрещённое слово)", parse_mode="HTML")
+            except Exception: pass
+            return
 
 
 # =============================================================================
@@ -1531,9 +1570,18 @@ async def periodic_cleanup():
         try: await db.cleanup_old_cache(3600)
         except Exception: pass
 
+async def on_expired(kind, pairs):
+    """Строки уже удалены планировщиком; Telegram снимает ограничения по until_date сам."""
+    if kind != "mute" or not ANNOUNCE_UNMUTES: return
+    async def one(c, uid):
+        name = await mention(uid, c)
+        await bot.send_message(c, f"🔊 {name} — срок мута истёк", parse_mode="HTML")
+    await asyncio.gather(*(one(c, uid) for uid, c in pairs), return_exceptions=True)
+
 async def main():
     global db, BOT_ID
-    db = Database("database.db")
+    db = Database("database.db", flush_interval=WRITE_BEHIND_INTERVAL_MS / 1000, flush_rows=WRITE_BEHIND_MAX_ROWS)
+    db.on_expire = on_expired
     await db.init()
     me = await bot.get_me()
     BOT_ID = me.id
@@ -1555,8 +1603,14 @@ async def main():
     await register_commands()
     asyncio.create_task(periodic_cleanup())
     await bot.delete_webhook(drop_pending_updates=True)
+    staff_log.start()
     logger.info("✅ Запущен!")
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"])
+    try:
+        await dp.start_polling(bot, allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"])
+    finally:
+        await staff_log.close()
+        await user_cache.close()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+Версионные миграции схемы SQLite.
+
+Миграция — dict {"version": int, "name": str, "online": bool, "apply": f},
+где apply(acquire) — корутина, а acquire() — async-контекст, выдающий
+соединение и коммитящий на выходе. Применённые версии пишутся в таблицу
+schema_version (по одной строке на версию).
+
+Обычные миграции (ALTER TABLE ADD COLUMN и т.п. — дёшево) выполняются на
+старте по порядку. Online-миграции (индексы, заполнение колонок) идут в
+фоне, когда бот уже работает: индекс строится одной командой, а backfill
+обновляет строки пачками, каждый раз отпуская блокировку на запись.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_SQL = ("CREATE TABLE IF NOT EXISTS schema_version ("
+                      "version INTEGER PRIMARY KEY, name TEXT, applied_at REAL)")
+
+
+def add_column(table: str, column: str, decl: str):
+    async def apply(acquire):
+        async with acquire() as conn:
+            async with conn.execute(f"PRAGMA table_info({table})") as cur:
+                cols = [r[1] for r in await cur.fetchall()]
+            if column not in cols:
+                await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return apply
+
+
+def execute(*statements: str):
+    async def apply(acquire):
+        async with acquire() as conn:
+            for sql in statements:
+                await conn.execute(sql)
+    return apply
+
+
+def backfill(table: str, set_sql: str, where_sql: str, batch: int = 500, pause: float = 0.05):
+    """UPDATE пачками по `batch` строк; where_sql должен перестать выполняться после set_sql."""
+    async def apply(acquire):
+        while True:
+            async with acquire() as conn:
+                cur = await conn.execute(
+                    f"UPDATE {table} SET {set_sql} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} WHERE {where_sql} LIMIT ?)", (batch,))
+                n = cur.rowcount
+            if n < batch:
+                return
+            await asyncio.sleep(pause)
+    return apply
+
+
+async def _applied(acquire) -> set:
+    async with acquire() as conn:
+        await conn.execute(SCHEMA_VERSION_SQL)
+        async with conn.execute("SELECT version FROM schema_version") as cur:
+            return {r[0] for r in await cur.fetchall()}
+
+
+async def _record(acquire, m: dict):
+    async with acquire() as conn:
+        await conn.execute("INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (?,?,?)",
+                           (m["version"], m["name"], time.time()))
+
+
+async def run_startup(acquire: Callable, migrations: List[dict]) -> List[dict]:
+    """Применяет обычные миграции; возвращает ещё не применённые online-миграции."""
+    done = await _applied(acquire)
+    pending = []
+    for m in sorted(migrations, key=lambda m: m["version"]):
+        if m["version"] in done:
+            continue
+        if m.get("online"):
+            pending.append(m)
+            continue
+        await m["apply"](acquire)
+        await _record(acquire, m)
+        logger.info(f"Миграция {m['version']} ({m['name']}) применена")
+    return pending
+
+
+async def run_online(acquire: Callable, migrations: List[dict], pause: float = 0.1) -> bool:
+    """Фоновые миграции по порядку; на ошибке останавливается (повтор — при следующем старте)."""
+    for m in migrations:
+        started = time.monotonic()
+        try:
+            await m["apply"](acquire)
+            await _record(acquire, m)
+        except Exception as e:
+            logger.warning(f"Миграция {m['version']} ({m['name']}) не удалась: {e}")
+            return False
+        logger.info(f"Миграция {m['version']} ({m['name']}) применена в фоне "
+                    f"за {time.monotonic() - started:.1f}с")
+        await asyncio.sleep(pause)
+    return True
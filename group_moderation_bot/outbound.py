@@ -0,0 +1,166 @@
+"""
+Планировщик исходящих запросов к Bot API — общий для обоих ботов.
+
+Лимиты Telegram: около 30 запросов/с на бота, отправка сообщений в чат —
+20/мин в группе и 1/с в личке. Общий bucket раздаёт токены по приоритету:
+сначала модерация, потом логи стафф-чата, потом личные сообщения.
+На RetryAfter упёршийся bucket встаёт на паузу, а запрос повторяется.
+Сам модуль не зависит от библиотеки бота — адаптеры лежат в ratelimit.py.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: меньше — раньше
+ENFORCE, LOGGING, DM = 0, 1, 2
+
+
+def is_send(method: str) -> bool:
+    return method.lower().startswith(("send", "copy", "forward"))
+
+
+class TokenBucket:
+    """`rate` токенов в секунду, не больше `capacity` про запас."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _take(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def _delay(self) -> float:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        while not self._take():
+            await asyncio.sleep(self._delay())
+
+    def pause(self, seconds: float):
+        # После паузы — ровно один токен: повтор уходит сразу, остальные ждут пополнения
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 1.0
+        self.updated = self.paused_until
+
+
+class PriorityBucket(TokenBucket):
+    """TokenBucket, который отдаёт токены ожидающим в порядке приоритета."""
+
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+
+    async def acquire(self, priority: int = ENFORCE):
+        if not self._waiters and self._take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        waiters = self._waiters
+        while waiters:
+            if waiters[0][2].done():  # ожидающего отменили
+                heapq.heappop(waiters)
+            elif self._take():
+                heapq.heappop(waiters)[2].set_result(None)
+            else:
+                await asyncio.sleep(self._delay())
+
+    def queued(self) -> int:
+        return len(self._waiters)
+
+
+class OutboundScheduler:
+    """Пропускает каждый запрос через bucket чата и общий приоритетный bucket."""
+
+    def __init__(self, log_chats: Iterable[int] = (), global_rate: float = 30,
+                 group_rate: float = 20 / 60, group_burst: int = 20,
+                 private_rate: float = 1, max_retries: int = 3,
+                 max_chats: int = 10_000):
+        self.log_chats = set(log_chats)
+        self.global_bucket = PriorityBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.retries = 0
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def priority(self, method: str, chat_id) -> int:
+        if not isinstance(chat_id, int) or not is_send(method):
+            return ENFORCE
+        if chat_id in self.log_chats:
+            return LOGGING
+        return DM if chat_id > 0 else ENFORCE
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def run(self, request: Callable[[], Awaitable], method: str, chat_id,
+                  retry_after: Callable[[BaseException], Optional[float]],
+                  priority: Optional[int] = None):
+        """Выполняет request() в рамках лимитов.
+
+        retry_after(exc) возвращает паузу в секундах для RetryAfter своей
+        библиотеки и None для остальных ошибок.
+        """
+        if priority is None:
+            priority = self.priority(method, chat_id)
+        bucket = self.chat_bucket(chat_id) if isinstance(chat_id, int) and is_send(method) else None
+        attempt = 0
+        while True:
+            if bucket is not None:
+                await bucket.acquire()
+            await self.global_bucket.acquire(priority)
+            try:
+                return await request()
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"RetryAfter {delay}с: {method} в {chat_id}")
+                (bucket or self.global_bucket).pause(delay)
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.global_bucket.queued(), "chats": len(self._chats),
+                "retries": self.retries}
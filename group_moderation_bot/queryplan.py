@@ -0,0 +1,40 @@
+"""
+Самопроверка планов запросов на старте.
+
+Для каждого горячего запроса выполняется EXPLAIN QUERY PLAN; если SQLite
+собирается читать таблицу целиком (SCAN без индекса) или сортировать во
+временном B-дереве, в лог пишется предупреждение — значит, индекс потерян
+или запрос перестал в него попадать.
+"""
+
+import logging
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _problems(details: List[str]) -> List[str]:
+    bad = []
+    for d in details:
+        if d.startswith("SCAN ") and " USING " not in d:
+            bad.append(d)
+        elif d.startswith("USE TEMP B-TREE"):
+            bad.append(d)
+    return bad
+
+
+async def check_query_plans(conn, queries: Dict[str, Tuple[str, tuple]]) -> List[str]:
+    """Проверяет запросы {имя: (sql, параметры)}; возвращает имена деградировавших."""
+    degraded = []
+    for name, (sql, params) in queries.items():
+        try:
+            async with conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cur:
+                details = [r[3] for r in await cur.fetchall()]
+        except Exception as e:
+            logger.warning(f"query plan {name}: {e}")
+            continue
+        bad = _problems(details)
+        if bad:
+            degraded.append(name)
+            logger.warning(f"Запрос {name} без индекса: {'; '.join(bad)}")
+    return degraded
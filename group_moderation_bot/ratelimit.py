@@ -0,0 +1,50 @@
+"""
+Адаптер OutboundScheduler для aiogram и параллельная рассылка по чатам.
+
+ApiThrottle вешается на bot.session, так что через планировщик проходит
+каждый запрос бота. fan_out() запускает действие по всем чатам
+параллельно и возвращает результат по каждому.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from outbound import OutboundScheduler
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    return e.retry_after if isinstance(e, TelegramRetryAfter) else None
+
+
+class ApiThrottle(BaseRequestMiddleware):
+    """Request-middleware aiogram поверх OutboundScheduler."""
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        return await self.scheduler.run(
+            lambda: make_request(bot, method), type(method).__name__,
+            getattr(method, "chat_id", None), _retry_after)
+
+
+async def fan_out(chat_ids: Iterable[int], action: Callable[[int], Awaitable],
+                  concurrency: int = 20) -> Dict[int, Optional[BaseException]]:
+    """Выполняет action(chat_id) по всем чатам параллельно.
+
+    Возвращает {chat_id: None | исключение}; темп запросов задаёт планировщик.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def run(c):
+        async with sem:
+            try:
+                await action(c)
+                return c, None
+            except Exception as e:
+                return c, e
+
+    return dict(await asyncio.gather(*(run(c) for c in chat_ids)))
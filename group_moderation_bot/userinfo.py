@@ -0,0 +1,97 @@
+"""
+Кэш имён пользователей (full_name, username) для mention / get_user_info.
+
+Наполняется даром из входящих апдейтов (put), а bot.get_chat вызывается
+только на промах. Запись свежая `ttl` секунд; устаревшая ещё отдаётся
+сразу, но в фоне перезапрашивается (stale-while-revalidate). Параллельные
+запросы одного пользователя ждут один общий get_chat.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+Fetch = Callable[[int], Awaitable[dict]]
+
+
+class UserInfoCache:
+    def __init__(self, ttl: float = 3600, max_size: int = 50_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self._data: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (info, fetched_at)
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # Фоновые перезапросы устаревших записей: сильные ссылки и не больше одного на user_id
+        self._refreshing: Dict[int, asyncio.Task] = {}
+
+    def put(self, user_id: int, full_name: str, username: Optional[str] = ""):
+        info = {"id": user_id, "username": username or "", "full_name": full_name or f"User {user_id}"}
+        self._store(user_id, info)
+
+    def _store(self, user_id: int, info: dict):
+        self._data[user_id] = (info, time.monotonic())
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def peek(self, user_id: int) -> Optional[dict]:
+        item = self._data.get(user_id)
+        return dict(item[0]) if item else None
+
+    async def get(self, user_id: int, fetch: Fetch) -> dict:
+        """Имя из кэша или через fetch(user_id); ошибки fetch на промахе пробрасываются."""
+        item = self._data.get(user_id)
+        if item is not None:
+            self._data.move_to_end(user_id)
+            info, fetched_at = item
+            if time.monotonic() - fetched_at < self.ttl:
+                self.hits += 1
+            else:
+                self.stale += 1
+                if user_id not in self._inflight and user_id not in self._refreshing:
+                    task = self._refreshing[user_id] = asyncio.create_task(self._refresh(user_id, fetch))
+                    task.add_done_callback(lambda _, uid=user_id: self._refreshing.pop(uid, None))
+            return dict(info)
+        self.misses += 1
+        return dict(await self._load(user_id, fetch))
+
+    async def _load(self, user_id: int, fetch: Fetch) -> dict:
+        fut = self._inflight.get(user_id)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = self._inflight[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            info = await fetch(user_id)
+            self._store(user_id, info)
+            fut.set_result(info)
+            return info
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем прочитанным, если никто не ждал
+            raise
+        finally:
+            del self._inflight[user_id]
+
+    async def _refresh(self, user_id: int, fetch: Fetch):
+        try:
+            await self._load(user_id, fetch)
+        except Exception as e:
+            logger.debug(f"user info refresh {user_id}: {e}")
+
+    async def close(self):
+        tasks = list(self._refreshing.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "stale": self.stale, "misses": self.misses}
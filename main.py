@@ -1,10 +1,14 @@
 """Точка входа."""
-import asyncio, logging
+import logging
 from telegram.constants import ParseMode
 from telegram.ext import (ApplicationBuilder, CommandHandler, CallbackQueryHandler,
                           MessageHandler, ConversationHandler, filters)
-from config import BOT_TOKEN, INTERFACE_BUTTONS
+from config import BOT_TOKEN, INTERFACE_BUTTONS, STAFF_CHAT_ID
 import database as db
+import staff_log
+import ai_moderation
+from outbound import OutboundScheduler
+from ratelimit import SchedulerRateLimiter
 from handlers import (cmd_start, cb_set_interface, cb_menu, cb_noop, cb_cancel,
                       AWAIT_TARGET, AWAIT_DURATION, AWAIT_REASON, AWAIT_SEARCH,
                       AWAIT_WORD_FILTER, AWAIT_REPORT_USER, AWAIT_REPORT_REASON, AWAIT_ROLE_TARGET)
@@ -17,7 +21,7 @@ from commands import (cmd_profile, cmd_top, cmd_settings, cmd_ban, cmd_unban, cm
                       cmd_unwarn, cmd_mute, cmd_unmute, cmd_editban, cmd_editmute,
                       cmd_globalban, cmd_users, cmd_find, cmd_online, cmd_staff,
                       cmd_setrole, cmd_report, cmd_reports, cmd_chatmod,
-                      group_message_handler, private_fallback)
+                      group_message_handler, private_fallback, apply_ai_verdict)
 
 from keyboards import main_menu_kb
 
@@ -59,8 +63,25 @@ def _guard_private_commands(func):
 
     return wrapper
 
+async def _on_startup(app):
+    await db.init_db()
+    staff_log.start_outbox(app.bot)
+    ai_moderation.queue.start(apply_ai_verdict)
+
+
+async def _on_shutdown(app):
+    await staff_log.stop_outbox()
+    await ai_moderation.queue.stop()
+    await ai_moderation.batcher.close()
+    await ai_moderation.close_session()
+    await db.close_db()
+
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    scheduler = OutboundScheduler(log_chats=[STAFF_CHAT_ID] if STAFF_CHAT_ID else [])
+    app = (ApplicationBuilder().token(BOT_TOKEN)
+           .rate_limiter(SchedulerRateLimiter(scheduler))
+           .post_init(_on_startup).post_shutdown(_on_shutdown).build())
     conv = ConversationHandler(
         entry_points=[
             CallbackQueryHandler(cb_action, pattern=r"^act:"),
@@ -113,7 +134,6 @@ def main():
     app.add_handler(CallbackQueryHandler(cb_noop, pattern=r"^noop$"))
     app.add_handler(MessageHandler(filters.ALL & filters.ChatType.GROUPS, group_message_handler))
     app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE & ~filters.COMMAND, private_fallback))
-    asyncio.get_event_loop().run_until_complete(db.init_db())
     logging.getLogger(__name__).info("Бот запущен")
     app.run_polling(drop_pending_updates=True)
 
@@ -0,0 +1,69 @@
+"""
+Keyset-пагинация для списков (баны, варны, пользователи).
+
+Страница читается от ключа последней строки предыдущей страницы
+(`WHERE (a, b) < (?, ?) ORDER BY a DESC, b DESC LIMIT n`) по индексу,
+а не через OFFSET, поэтому глубокие страницы стоят как первая. Ключи
+границ страниц и COUNT(*) кэшируются на `ttl` секунд: номер страницы
+и «всего» приблизительны, если список меняется между запросами.
+"""
+
+import time
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple
+
+Fetch = Callable[[str, tuple], Awaitable[Sequence]]
+
+
+class KeysetPager:
+    def __init__(self, table: str, keys: Tuple[str, str], ttl: float = 60.0, max_scopes: int = 1000):
+        self.table = table
+        self.keys = keys
+        self.ttl = ttl
+        self.max_scopes = max_scopes
+        self._scopes: Dict[tuple, dict] = {}
+
+    def _after(self, cursor) -> Tuple[str, tuple]:
+        if cursor is None:
+            return "", ()
+        return f" AND ({self.keys[0]}, {self.keys[1]}) < (?, ?)", tuple(cursor)
+
+    async def _scope(self, fetch: Fetch, where: str, params: tuple, per_page: int) -> dict:
+        key = (where, params, per_page)
+        now = time.monotonic()
+        scope = self._scopes.get(key)
+        if scope is None or now - scope["at"] > self.ttl:
+            rows = await fetch(f"SELECT COUNT(*) FROM {self.table} WHERE {where}", params)
+            if len(self._scopes) >= self.max_scopes:
+                self._scopes.clear()
+            # cursors[p] — ключ последней строки страницы p
+            scope = self._scopes[key] = {"at": now, "total": rows[0][0], "cursors": {}}
+        return scope
+
+    async def page(self, fetch: Fetch, page: int, per_page: int,
+                   where: str = "1", params: tuple = ()) -> Tuple[List[dict], int]:
+        """Строки страницы `page` (с нуля) и приблизительное общее число."""
+        scope = await self._scope(fetch, where, params, per_page)
+        cursors = scope["cursors"]
+        a, b = self.keys
+        order = f"ORDER BY {a} DESC, {b} DESC"
+        known = max((p for p in cursors if p < page), default=-1)
+        if known < page - 1:
+            # Доходим до нужной страницы по одному индексу, попутно запоминая границы
+            cond, cp = self._after(cursors.get(known))
+            skip = (page - 1 - known) * per_page
+            keys = await fetch(f"SELECT {a}, {b} FROM {self.table} WHERE {where}{cond} {order} LIMIT ?",
+                               params + cp + (skip,))
+            for i in range(per_page - 1, len(keys), per_page):
+                known += 1
+                cursors[known] = (keys[i][0], keys[i][1])
+            if known < page - 1:
+                return [], scope["total"]
+        cond, cp = self._after(cursors.get(page - 1))
+        rows = await fetch(f"SELECT {b} AS _key, * FROM {self.table} WHERE {where}{cond} {order} LIMIT ?",
+                           params + cp + (per_page,))
+        result = [dict(r) for r in rows]
+        if len(result) == per_page:
+            cursors[page] = (result[-1][a], result[-1]["_key"])
+        for d in result:
+            d.pop("_key")
+        return result, scope["total"]
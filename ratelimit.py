@@ -0,0 +1,37 @@
+"""Адаптер OutboundScheduler для python-telegram-bot (BaseRateLimiter)."""
+
+from __future__ import annotations
+
+from typing import Any, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from outbound import OutboundScheduler
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    return float(e.retry_after) if isinstance(e, RetryAfter) else None
+
+
+class SchedulerRateLimiter(BaseRateLimiter[int]):
+    """Все запросы ExtBot идут через общий планировщик.
+
+    rate_limit_args у методов бота — необязательный класс приоритета
+    (outbound.ENFORCE / LOGGING / DM), иначе он выводится из метода и чата.
+    """
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data: dict[str, Any],
+                              rate_limit_args: Optional[int]):
+        return await self.scheduler.run(
+            lambda: callback(*args, **kwargs), endpoint, data.get("chat_id"),
+            _retry_after, priority=rate_limit_args)
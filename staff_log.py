@@ -1,26 +1,138 @@
 """
 Логирование действий в стафф-чат с поддержкой топиков.
+
+Сообщения не отправляются из команды: они кладутся в таблицу staff_outbox,
+а фоновый отправщик (start_outbox / stop_outbox) шлёт их по порядку внутри
+топика, с повторами и переживая перезапуск.
 """
 
+import asyncio
 import logging
+import time
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
-from config import STAFF_CHAT_ID, LOG_TOPIC_ID, GBAN_TOPIC_ID, PUNISH_TOPIC_ID, REPORT_TOPIC_ID
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from config import (STAFF_CHAT_ID, LOG_TOPIC_ID, GBAN_TOPIC_ID, PUNISH_TOPIC_ID, REPORT_TOPIC_ID,
+                    STAFF_OUTBOX_CONCURRENCY)
+import database as db
 from utils import escape_html
 
 logger = logging.getLogger(__name__)
 
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_DB_BACKOFF = 30
+
+_bot = None
+_wake: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+# topic_id -> время, до которого топик не трогаем после ошибки БД
+_held: dict[int, float] = {}
+# id уже отправленных логов, которые не удалось убрать из очереди: повторно не шлём
+_sent: set[int] = set()
+
 
 async def _send_to_topic(bot, topic_id: int, text: str):
     if not STAFF_CHAT_ID:
         return
     try:
-        kwargs = {"chat_id": STAFF_CHAT_ID, "text": text, "parse_mode": ParseMode.HTML}
-        if topic_id:
-            kwargs["message_thread_id"] = topic_id
-        await bot.send_message(**kwargs)
+        await db.enqueue_staff_log(topic_id, text)
+    except Exception as e:
+        logger.warning(f"Не удалось поставить лог в очередь: {e}")
+        return
+    if _wake is not None:
+        _wake.set()
+
+
+def start_outbox(bot):
+    global _bot, _wake, _task
+    _bot = bot
+    _wake = asyncio.Event()
+    _wake.set()  # сразу добираем то, что осталось с прошлого запуска
+    _task = asyncio.create_task(_outbox_loop())
+
+
+async def stop_outbox():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+async def _deliver(entry: dict) -> bool:
+    """True — запись можно убрать из очереди (отправлена или безнадёжна)."""
+    kwargs = {"chat_id": STAFF_CHAT_ID, "text": entry["text"], "parse_mode": ParseMode.HTML}
+    if entry["topic_id"]:
+        kwargs["message_thread_id"] = entry["topic_id"]
+    try:
+        await _bot.send_message(**kwargs)
+        return True
+    except (BadRequest, Forbidden) as e:
+        logger.warning(f"Лог #{entry['id']} отброшен: {e}")
+        return True
     except Exception as e:
-        logger.warning(f"Не удалось отправить лог: {e}")
+        attempts = entry["attempts"] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            logger.warning(f"Лог #{entry['id']} отброшен после {attempts} попыток: {e}")
+            return True
+        delay = e.retry_after if isinstance(e, RetryAfter) else min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+        await db.defer_staff_log(entry["id"], time.time() + float(delay))
+        return False
+
+
+async def _drain_topic(entries: list, sem: asyncio.Semaphore):
+    # Внутри топика строго по порядку: на первой неудаче топик ждёт следующего круга
+    async with sem:
+        for entry in entries:
+            try:
+                if entry["id"] not in _sent:
+                    if not await _deliver(entry):
+                        return
+                    _sent.add(entry["id"])
+                await db.delete_staff_log(entry["id"])
+                _sent.discard(entry["id"])
+            except Exception as e:
+                # Ошибка БД в defer/delete: иначе следующий круг сразу взял бы ту же строку
+                logger.warning(f"staff outbox: {e}")
+                _held[entry["topic_id"]] = time.time() + OUTBOX_DB_BACKOFF
+                return
+
+
+def _ready_at(entries: list) -> float:
+    return max(entries[0]["next_at"], _held.get(entries[0]["topic_id"], 0))
+
+
+async def _outbox_loop():
+    sem = asyncio.Semaphore(STAFF_OUTBOX_CONCURRENCY)
+    while True:
+        await _wake.wait()
+        _wake.clear()
+        try:
+            rows = await db.get_staff_outbox()
+        except Exception as e:
+            logger.warning(f"staff outbox: {e}")
+            rows = []
+        now = time.time()
+        topics: dict[int, list] = {}
+        for r in rows:
+            topics.setdefault(r["topic_id"], []).append(r)
+        # Топик, чья голова ещё ждёт повтора (или топик на паузе после ошибки БД), пропускаем целиком
+        due = [t for t in topics.values() if _ready_at(t) <= now]
+        if due:
+            await asyncio.gather(*(_drain_topic(t, sem) for t in due))
+            _wake.set()
+            continue
+        if topics:
+            wait = min(_ready_at(t) for t in topics.values()) - now
+            try:
+                await asyncio.wait_for(_wake.wait(), timeout=max(0.1, wait))
+            except asyncio.TimeoutError:
+                pass
+            _wake.set()
 
 
 async def log_action(bot, text: str):
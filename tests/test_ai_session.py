@@ -0,0 +1,65 @@
+"""Общая HTTP-сессия ИИ-модерации: одно keep-alive соединение и чистое закрытие."""
+
+import asyncio
+import gc
+import json
+import socket
+import warnings
+
+from aiohttp import web
+
+import ai_moderation as ai
+
+
+async def _stand_in(seen: dict):
+    """Заглушка API; seen["peers"] — адреса клиентов, seen["requests"] — число запросов."""
+    async def handler(request):
+        seen["peers"].add(request.transport.get_extra_info("peername"))
+        seen["requests"] += 1
+        body = await request.json()
+        try:
+            items = json.loads(body["messages"][1]["content"])
+        except ValueError:
+            items = None
+        if isinstance(items, list):
+            content = [{"id": it["id"], "violation": False, "action": "none"} for it in items]
+        else:
+            content = {"violation": False, "action": "none"}
+        return web.json_response({"choices": [{"message": {"content": json.dumps(content)}}]})
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    port = sock.getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/chat/completions"
+
+
+def test_session_reused_and_closed(monkeypatch):
+    seen = {"peers": set(), "requests": 0}
+
+    async def scenario():
+        runner, url = await _stand_in(seen)
+        monkeypatch.setattr(ai, "PERPLEXITY_API_URL", url)
+        try:
+            assert await ai._request_batch(["раз"]) == [{"violation": False, "action": "none"}]
+            session = ai._session
+            assert len(await ai._request_batch(["два", "три"])) == 2
+            assert (await ai._request("четыре"))["action"] == "none"
+            assert ai._session is session
+            await ai.close_session()
+            assert session.closed and ai._session is None
+        finally:
+            await ai.close_session()
+            await runner.cleanup()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        asyncio.run(scenario())
+        gc.collect()
+    assert seen["requests"] == 3
+    assert len(seen["peers"]) == 1
+    assert not [w for w in caught if "Unclosed" in str(w.message)]
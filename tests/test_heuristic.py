@@ -0,0 +1,12 @@
+"""Локальный фолбэк ИИ-модерации: heuristic_verdict."""
+
+import ai_moderation as ai
+
+
+def test_two_telegram_links_are_not_spam():
+    assert ai.heuristic_verdict("канал https://t.me/news и чат https://t.me/chat") is None
+
+
+def test_three_links_are_spam():
+    verdict = ai.heuristic_verdict("https://t.me/a www.example.com http://example.org/x")
+    assert verdict["action"] == "delete"
@@ -0,0 +1,73 @@
+"""
+Поиск запрещённых слов — автомат Ахо-Корасик.
+
+Автомат строится один раз на весь список слов чата и находит вхождение
+любого из них за один проход по тексту, поэтому время проверки сообщения
+не растёт с количеством слов в фильтре.
+"""
+
+from collections import deque
+from typing import Iterable, Optional
+
+
+class WordMatcher:
+    """Скомпилированный набор слов для поиска подстрок.
+
+    Слова приводятся к нижнему регистру при сборке; текст в find()
+    ожидается уже в нижнем регистре (как и раньше при `word in text`).
+    """
+
+    __slots__ = ("_goto", "_fail", "_out", "size")
+
+    def __init__(self, words: Iterable[str]):
+        goto: list[dict[str, int]] = [{}]
+        out: list[Optional[str]] = [None]
+        unique = {w.lower() for w in words if w}
+        for word in unique:
+            node = 0
+            for ch in word:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(None)
+                node = nxt
+            out[node] = word
+
+        # Суффиксные ссылки строятся обходом в ширину; out узла дополняется
+        # словом, заканчивающимся в его суффиксе, чтобы find() не ходил по цепочке.
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if node else 0
+                if out[nxt] is None:
+                    out[nxt] = out[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self.size = len(unique)
+
+    def find(self, text: str) -> Optional[str]:
+        """Возвращает первое найденное слово или None."""
+        if not self.size:
+            return None
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None:
+                return out[node]
+        return None
+
+    def __len__(self):
+        return self.size